@@ -0,0 +1,155 @@
+import argparse
+import csv
+import glob
+import os
+import shutil
+import tempfile
+import traceback
+import unittest
+from main import (
+    add_output_arguments,
+    add_timing_arguments,
+    get_output_options,
+    get_timing_options,
+    print_peak_memory,
+    render_route
+)
+from map_file import find_map_from_wp, release_map_raster
+from profiler import profiling_requested
+from route import read_route_waypoints
+from tot_planner import parse_time
+
+
+def get_route_names(patterns):
+    # Route names or route CSV globs, every route in ./routes when none are given
+    if len(patterns) == 0:
+        patterns = ["./routes/*.csv"]
+    names = []
+    for pattern in patterns:
+        if pattern.endswith(".csv") or glob.has_magic(pattern):
+            filenames = sorted(glob.glob(pattern))
+            if len(filenames) == 0:
+                raise Exception("%s matched no route files" % pattern)
+            names += list(map(lambda i: os.path.splitext(os.path.basename(i))[0], filenames))
+        else:
+            names.append(pattern)
+    return names
+
+
+def read_manifest(filename):
+    # One row per route of name, start time, ToT, either time may be left blank
+    routes = []
+    with open(filename, newline='') as csv_file:
+        reader = csv.reader(csv_file, delimiter=',', quotechar='|')
+        for i, record in enumerate(reader):
+            fields = list(map(lambda j: j.strip(), record)) + ["", ""]
+            if i == 0 or fields[0] == "":
+                continue
+            start_time = (0, 0, 0) if fields[1] == "" else parse_time(fields[1])
+            time_on_target = None if fields[2] == "" else parse_time(fields[2])
+            routes.append((fields[0], start_time, time_on_target))
+    return routes
+
+
+def find_route_theatre(route_name):
+    if not os.path.exists("./routes/%s.csv" % route_name):
+        raise Exception("%s route file not found" % route_name)
+    waypoints = read_route_waypoints(route_name)
+    if len(waypoints) == 0:
+        raise Exception("%s route is empty" % route_name)
+    theatre = find_map_from_wp(waypoints[0].lat, waypoints[0].long)
+    if theatre is None:
+        raise Exception("%s route is not within any known map" % route_name)
+    return theatre
+
+
+# A route that can't be read or placed is reported and its name added to failed, the rest are still grouped
+def group_routes_by_theatre(routes, failed):
+    # dict - string - list
+    # theatre name, routes drawn on it in the order given
+    theatres = {}
+    for route in routes:
+        try:
+            theatre = find_route_theatre(route[0])
+        except Exception:
+            traceback.print_exc()
+            failed.append(route[0])
+            continue
+        theatres.setdefault(theatre, []).append(route)
+    return theatres
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate dead reckoning kneeboards for many routes at once")
+    parser.add_argument("routes", nargs="*", help="route names or route CSV globs, all of ./routes by default")
+    parser.add_argument("--manifest", help="CSV of route name, start time, ToT per route, instead of routes")
+    parser.add_argument("--jobs", type=int, default=1, help="number of boards to render in parallel")
+    parser.add_argument("--profile", action="store_true", help="write profile.json for every route")
+    parser.add_argument("--force", action="store_true", help="render every board, even those unchanged since the last run")
+    add_output_arguments(parser)
+    add_timing_arguments(parser)
+    args = parser.parse_args()
+
+    if args.manifest is not None:
+        if len(args.routes) > 0:
+            parser.error("give either routes or --manifest, not both")
+        routes = read_manifest(args.manifest)
+    else:
+        routes = list(map(lambda i: (i, (0, 0, 0), None), get_route_names(args.routes)))
+
+    output = get_output_options(args)
+    timing = get_timing_options(args)
+    failed = []
+    for (theatre, theatre_routes) in group_routes_by_theatre(routes, failed).items():
+        print("%s: %s routes" % (theatre, len(theatre_routes)))
+        # Every route on this theatre draws from the one raster, decoded by the first of them
+        for (route_name, start_time, time_on_target) in theatre_routes:
+            try:
+                render_route(
+                    route_name,
+                    start_time,
+                    time_on_target,
+                    args.jobs,
+                    args.profile or profiling_requested(),
+                    force=args.force,
+                    **output,
+                    **timing
+                )
+            except Exception:
+                traceback.print_exc()
+                failed.append(route_name)
+        release_map_raster(theatre)
+
+    print_peak_memory(args.max_memory)
+    if len(failed) > 0:
+        raise SystemExit("failed routes: %s" % ", ".join(failed))
+
+
+class TestBatch(unittest.TestCase):
+    def test_bad_routes_are_skipped_when_grouping(self):
+        start_folder = os.getcwd()
+        folder = tempfile.mkdtemp()
+        try:
+            os.chdir(folder)
+            os.makedirs("./data/synthetic")
+            os.makedirs("./routes")
+            with open("./data/synthetic/map.csv", "w") as f:
+                f.write("lat, long, x, y\n")
+                for lat in range(41, 46):
+                    for long in range(37, 41):
+                        f.write("%s, %s, %s, %s\n" % (lat, long, (long - 37) * 1000, (45 - lat) * 1000))
+            with open("./routes/good.csv", "w") as f:
+                f.write("name, latd, latm, lats, longd, longm, longs, tags\nA, 44, 0, 0, 38, 0, 0, TGT\n")
+            with open("./routes/broken.csv", "w") as f:
+                f.write("name, latd, latm, lats, longd, longm, longs, tags\nA, 44\n")
+            routes = list(map(lambda i: (i, (0, 0, 0), None), ["broken", "good", "missing"]))
+            failed = []
+            self.assertEqual(group_routes_by_theatre(routes, failed), {"synthetic": [routes[1]]})
+            self.assertEqual(failed, ["broken", "missing"])
+        finally:
+            os.chdir(start_folder)
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from map_file import MapFile
+from map_tiles import build_tiles
+from route import Route
+from tot_planner import get_waypoint_times, hours_to_time
+
+benchmark_map_name = "bench"
+benchmark_route_name = "bench"
+# whole degree lat/long of the synthetic map's top left corner
+benchmark_map_corner = (45, 37)
+
+
+def write_synthetic_map(width, height, pixels_per_degree, seed):
+    # Coarse noise blown up to map size, so the JPEG compresses and decodes roughly like terrain imagery
+    rng = np.random.default_rng(seed)
+    os.makedirs("./data/%s" % benchmark_map_name, exist_ok=True)
+    coarse = rng.integers(0, 255, (max(height // 40, 1), max(width // 40, 1), 3), dtype=np.uint8)
+    img = Image.fromarray(coarse).resize((width, height), Image.BICUBIC)
+    img.save("./data/%s/map.jpg" % benchmark_map_name, quality=90)
+
+    (lat_top, long_left) = benchmark_map_corner
+    with open("./data/%s/map.csv" % benchmark_map_name, "w") as f:
+        f.write("lat, long, x, y\n")
+        for lat in range(lat_top - math.ceil(height / pixels_per_degree) - 1, lat_top + 1):
+            for long in range(long_left, long_left + math.ceil(width / pixels_per_degree) + 2):
+                f.write("%s, %s, %s, %s\n" % (
+                    lat,
+                    long,
+                    (long - long_left) * pixels_per_degree,
+                    (lat_top - lat) * pixels_per_degree
+                ))
+
+
+def to_dms(degrees):
+    whole = math.floor(degrees)
+    minutes = math.floor((degrees - whole) * 60)
+    seconds = math.floor(((degrees - whole) * 60 - minutes) * 60)
+    return whole, minutes, seconds
+
+
+def write_synthetic_route(width, height, pixels_per_degree, waypoint_count, leg_length, seed):
+    # A random walk of legs about leg_length nautical miles long that stays inside the map
+    rng = random.Random(seed)
+    (lat_top, long_left) = benchmark_map_corner
+    lat_bounds = (lat_top - (height / pixels_per_degree) * 0.9, lat_top - (height / pixels_per_degree) * 0.1)
+    long_bounds = (long_left + (width / pixels_per_degree) * 0.1, long_left + (width / pixels_per_degree) * 0.9)
+    lat = sum(lat_bounds) / 2
+    long = sum(long_bounds) / 2
+    heading = rng.uniform(0, 2 * math.pi)
+
+    with open("./routes/%s.csv" % benchmark_route_name, "w") as f:
+        f.write("name, latd, latm, lats, longd, longm, longs, tags\n")
+        for i in range(waypoint_count):
+            tags = []
+            if i == waypoint_count - 2:
+                tags.append("IP")
+            if i == waypoint_count - 1:
+                tags.append("TGT")
+            f.write(", ".join(["WP%s" % (i + 1)] + list(map(str, to_dms(lat) + to_dms(long))) + tags) + "\n")
+
+            heading += rng.uniform(-1, 1)
+            next_lat = lat + math.cos(heading) * leg_length / 60
+            next_long = long + math.sin(heading) * leg_length / (60 * math.cos(math.radians(lat)))
+            if not lat_bounds[0] < next_lat < lat_bounds[1] or not long_bounds[0] < next_long < long_bounds[1]:
+                heading += math.pi
+                next_lat = lat + math.cos(heading) * leg_length / 60
+                next_long = long + math.sin(heading) * leg_length / (60 * math.cos(math.radians(lat)))
+            lat = min(max(next_lat, lat_bounds[0]), lat_bounds[1])
+            long = min(max(next_long, long_bounds[0]), long_bounds[1])
+
+
+def get_reachable_time_on_target():
+    # Time to fly the whole route at the 300kts minimum cruise and 6 minutes more, so the ToT is always reachable
+    # with a cruise speed inside the planner's limits, holding for whatever is left over
+    route = Route(benchmark_route_name)
+    distance = sum(map(lambda wp: 0 if wp.distance_from_last is None else wp.distance_from_last, route.waypoints))
+    return hours_to_time(distance / 300 + 0.1)
+
+
+# Each stage does its setup and returns the work to be timed
+
+
+def stage_route_parse(time_on_target):
+    return lambda: Route(benchmark_route_name, (0, 0, 0), time_on_target)
+
+
+def stage_map_load():
+    return lambda: MapFile(benchmark_map_name).get_map_image().load()
+
+
+def stage_get_pixels_for(point_count):
+    test_map = MapFile(benchmark_map_name)
+    (lats, longs) = get_benchmark_points(test_map, point_count)
+
+    def run():
+        for lat, long in zip(lats, longs):
+            test_map.get_pixels_for(lat, long)
+    return run
+
+
+def stage_get_pixels_for_many(point_count):
+    test_map = MapFile(benchmark_map_name)
+    (lats, longs) = get_benchmark_points(test_map, point_count)
+    return lambda: test_map.get_pixels_for_many(lats, longs)
+
+
+def get_benchmark_points(test_map, point_count):
+    rng = random.Random(point_count)
+    cells = list(test_map.cell_transforms.keys())
+    lats = []
+    longs = []
+    for i in range(point_count):
+        (lat_d, long_d) = rng.choice(cells)
+        lats.append((lat_d, rng.randint(0, 59), rng.randint(0, 59)))
+        longs.append((long_d, rng.randint(0, 59), rng.randint(0, 59)))
+    return lats, longs
+
+
+def stage_get_waypoint_times(time_on_target, repeats):
+    route = Route(benchmark_route_name, (0, 0, 0), time_on_target)
+    [target_wp] = [x for x in route.waypoints if "TGT" in x.tags]
+    distances = list(map(lambda wp: wp.distance_from_last, route.waypoints[0:target_wp.index + 1]))
+
+    def run():
+        # get_waypoint_times prints the times it plans between, which would otherwise be most of what is timed
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for i in range(repeats):
+                get_waypoint_times(distances, (0, 0, 0), time_on_target)
+    return run
+
+
+def stage_save_boards(time_on_target, jobs):
+    route = Route(benchmark_route_name, (0, 0, 0), time_on_target)
+    os.makedirs("./%s" % benchmark_route_name, exist_ok=True)
+    return lambda: route.save_boards(jobs)
+
+
+def run_stage(connection, stage, args):
+    work = stage(*args)
+    start = time.perf_counter()
+    work()
+    connection.send((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def measure_stage(stage, args):
+    # Each stage runs in a fresh forked process so its peak RSS isn't hidden by earlier stages
+    context = multiprocessing.get_context("fork")
+    (receiver, sender) = context.Pipe(duplex=False)
+    process = context.Process(target=run_stage, args=(sender, stage, args))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise Exception("%s failed" % stage.__name__)
+    (seconds, peak_kb) = receiver.recv()
+    return {"stage": stage.__name__.replace("stage_", ""), "seconds": seconds, "peak_rss_mb": peak_kb / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the kneeboard pipeline against a synthetic theatre and route")
+    parser.add_argument("--map-size", default="8000x6000", help="synthetic map size in pixels as WIDTHxHEIGHT")
+    parser.add_argument("--pixels-per-degree", type=int, default=1000)
+    parser.add_argument("--waypoints", type=int, default=30)
+    parser.add_argument("--leg-length", type=float, default=15, help="approximate leg length in nautical miles")
+    parser.add_argument("--points", type=int, default=10000, help="points converted by the pixel stages")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--tiles", action="store_true", help="build map tiles before rendering")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", help="build the synthetic theatre in this folder and keep it afterwards")
+    args = parser.parse_args()
+
+    (width, height) = map(int, args.map_size.split("x"))
+    working_folder = args.keep or tempfile.mkdtemp(prefix="kneeboard-bench-")
+    output_filename = None if args.json is None else os.path.abspath(args.json)
+    start_folder = os.getcwd()
+    os.makedirs(working_folder, exist_ok=True)
+    # The pipeline reads ./data and ./routes, so the benchmark runs from inside its synthetic theatre
+    os.chdir(working_folder)
+    try:
+        os.makedirs("./routes", exist_ok=True)
+        write_synthetic_map(width, height, args.pixels_per_degree, args.seed)
+        write_synthetic_route(width, height, args.pixels_per_degree, args.waypoints, args.leg_length, args.seed)
+        if args.tiles:
+            build_tiles(benchmark_map_name)
+        time_on_target = get_reachable_time_on_target()
+
+        results = [
+            measure_stage(stage_route_parse, (time_on_target,)),
+            measure_stage(stage_map_load, ()),
+            measure_stage(stage_get_pixels_for, (args.points,)),
+            measure_stage(stage_get_pixels_for_many, (args.points,)),
+            measure_stage(stage_get_waypoint_times, (time_on_target, 1000)),
+            measure_stage(stage_save_boards, (time_on_target, args.jobs)),
+        ]
+    finally:
+        os.chdir(start_folder)
+        if args.keep is None:
+            shutil.rmtree(working_folder)
+
+    print("%-22s %10s %14s" % ("stage", "seconds", "peak RSS MB"))
+    for result in results:
+        print("%-22s %10.3f %14.1f" % (result["stage"], result["seconds"], result["peak_rss_mb"]))
+    if output_filename is not None:
+        with open(output_filename, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+import zlib
+from PIL import Image, PdfParser
+from route import board_output_size
+
+# board pixels per inch on a PDF page
+bundle_dpi = 200
+# largest page side PDF readers take, in points
+max_page_points = 14400
+notes_font_size = 12
+# rows of a lossless page compressed at a time
+band_height = 256
+length_placeholder = b"0" * 10
+
+
+class PdfBundle:
+    # Writes a PDF a page at a time, JPEG boards go in as they are and anything else is compressed losslessly,
+    # so only the page being added is ever held. Written to a temporary file that replaces filename on close
+    filename = None
+    temp_filename = None
+    file = None
+    # dict - number - number
+    # object number, offset in the file
+    offsets = None
+    # list - number
+    # object numbers of the pages in order
+    page_numbers = None
+    next_number = None
+    font_number = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        (handle, self.temp_filename) = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(filename))
+        self.file = os.fdopen(handle, "wb")
+        self.offsets = {}
+        self.page_numbers = []
+        # 1 and 2 are the catalog and page tree, written once every page is known
+        self.next_number = 3
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def new_number(self):
+        self.next_number += 1
+        return self.next_number - 1
+
+    def write_object(self, number, body):
+        self.offsets[number] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    def start_stream(self, number, dictionary):
+        self.offsets[number] = self.file.tell()
+        self.file.write(b"%d 0 obj\n<< " % number + dictionary + b" >>\nstream\n")
+
+    def end_stream(self):
+        self.file.write(b"\nendstream\nendobj\n")
+
+    def add_page(self, page_size, resources, content):
+        content_number = self.new_number()
+        self.write_object(content_number, b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        page_number = self.new_number()
+        self.write_object(
+            page_number,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] /Resources << %s >> /Contents %d 0 R >>" % (
+                format_number(page_size[0]).encode(), format_number(page_size[1]).encode(), resources, content_number
+            )
+        )
+        self.page_numbers.append(page_number)
+
+    def add_notes(self, text):
+        # As many pages of the boards' size as the notes need, in a fixed width font so their columns line up
+        if self.font_number is None:
+            self.font_number = self.new_number()
+            self.write_object(
+                self.font_number,
+                b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>"
+            )
+        (page_width, page_height) = get_page_size(board_output_size)
+        lines = list(map(lambda i: i.expandtabs(8), text.rstrip("\n").split("\n")))
+        # Courier is 0.6 of its size wide
+        size = min(notes_font_size, page_width * 0.9 / (max(map(len, lines)) * 0.6 or 1))
+        leading = size * 1.2
+        lines_per_page = max(int((page_height - 2 * leading) // leading), 1)
+        for first in range(0, len(lines), lines_per_page):
+            content = b"BT /F1 %s Tf %s TL %s %s Td\n" % tuple(map(lambda i: format_number(i).encode(), (
+                size, leading, page_width * 0.05, page_height - 2 * leading
+            )))
+            for line in lines[first:first + lines_per_page]:
+                content += b"(%s) Tj T*\n" % escape_text(line)
+            content += b"ET"
+            self.add_page((page_width, page_height), b"/Font << /F1 %d 0 R >>" % self.font_number, content)
+
+    def add_board(self, filename):
+        image_number = self.new_number()
+        with Image.open(filename) as img:
+            size = img.size
+            dictionary = (
+                b"/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8" % size
+            )
+            if img.format == "JPEG" and img.mode == "RGB":
+                # JPEG data is a valid PDF image stream as it is, so it is copied across without decoding
+                length = os.path.getsize(filename)
+                self.start_stream(image_number, dictionary + b" /Filter /DCTDecode /Length %d" % length)
+                with open(filename, "rb") as f:
+                    shutil.copyfileobj(f, self.file)
+                self.end_stream()
+            else:
+                rgb = img.convert("RGB")
+                # The compressed length is only known once it is written, so a fixed width one is filled in after
+                self.start_stream(image_number, dictionary + b" /Filter /FlateDecode /Length %s" % length_placeholder)
+                start = self.file.tell()
+                compressor = zlib.compressobj()
+                for y in range(0, rgb.height, band_height):
+                    band = rgb.crop((0, y, rgb.width, min(y + band_height, rgb.height)))
+                    self.file.write(compressor.compress(band.tobytes()))
+                self.file.write(compressor.flush())
+                end = self.file.tell()
+                self.file.seek(start - len(length_placeholder + b" >>\nstream\n"))
+                self.file.write(b"%010d" % (end - start))
+                self.file.seek(end)
+                self.end_stream()
+        page_size = get_page_size(size)
+        self.add_page(
+            page_size,
+            b"/XObject << /Im0 %d 0 R >>" % image_number,
+            b"q %s 0 0 %s 0 0 cm /Im0 Do Q" % (format_number(page_size[0]).encode(), format_number(page_size[1]).encode())
+        )
+
+    def close(self):
+        self.write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+            b" ".join(map(lambda i: b"%d 0 R" % i, self.page_numbers)), len(self.page_numbers)
+        ))
+        self.write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref_offset = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_number)
+        for number in range(1, self.next_number):
+            self.file.write(b"%010d 00000 n \n" % self.offsets[number])
+        self.file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_number, xref_offset))
+        self.file.close()
+        replace_bundle(self.temp_filename, self.filename)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_filename)
+
+
+class ZipBundle:
+    # Boards are stored as they are, already being compressed images, and each is copied in from its file
+    filename = None
+    temp_filename = None
+    archive = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        (handle, self.temp_filename) = tempfile.mkstemp(suffix=".zip", dir=os.path.dirname(filename))
+        os.close(handle)
+        self.archive = zipfile.ZipFile(self.temp_filename, "w")
+
+    def add_notes(self, text):
+        self.archive.writestr("notes.txt", text, compress_type=zipfile.ZIP_DEFLATED)
+
+    def add_board(self, filename):
+        self.archive.write(filename, os.path.basename(filename))
+
+    def close(self):
+        self.archive.close()
+        replace_bundle(self.temp_filename, self.filename)
+
+    def discard(self):
+        self.archive.close()
+        os.remove(self.temp_filename)
+
+
+# dict - string - class
+# bundle file extension, the class writing it
+bundle_formats = {"pdf": PdfBundle, "zip": ZipBundle}
+
+
+def open_bundle(filename, bundle_format):
+    return bundle_formats[bundle_format](filename)
+
+
+def replace_bundle(temp_filename, filename):
+    # mkstemp leaves the file readable by its owner alone
+    os.chmod(temp_filename, 0o644)
+    os.replace(temp_filename, filename)
+
+
+def get_page_size(size):
+    # in points, at bundle_dpi unless that would make the page too large to open
+    scale = min(72 / bundle_dpi, max_page_points / max(size))
+    return size[0] * scale, size[1] * scale
+
+
+def format_number(number):
+    return ("%.3f" % number).rstrip("0").rstrip(".")
+
+
+def escape_text(text):
+    # A PDF string in the font's WinAnsiEncoding
+    text = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return text.encode("cp1252", "replace")
+
+
+class TestBundle(unittest.TestCase):
+    def test_pdf_has_a_page_per_board_and_notes(self):
+        with tempfile.TemporaryDirectory() as folder:
+            Image.new("RGB", (160, 240), "red").save("%s/wp1.jpg" % folder)
+            Image.new("RGB", (160, 240), "blue").save("%s/wp2.png" % folder)
+            bundle = PdfBundle("%s/route.pdf" % folder)
+            bundle.add_notes("A\tN43 10 E38 20\t500\nB (IP)\tN43 30 E39 40\tIP\n")
+            bundle.add_board("%s/wp1.jpg" % folder)
+            bundle.add_board("%s/wp2.png" % folder)
+            bundle.close()
+            pdf = PdfParser.PdfParser("%s/route.pdf" % folder)
+            self.assertEqual(len(pdf.pages), 3)
+            png_page = pdf.read_indirect(pdf.read_indirect(pdf.pages[2])[b"Resources"][b"XObject"][b"Im0"])
+            self.assertEqual(png_page.decode(), Image.new("RGB", (160, 240), "blue").tobytes())
+            self.assertEqual(sorted(os.listdir(folder)), ["route.pdf", "wp1.jpg", "wp2.png"])
+
+    def test_zip_holds_notes_and_boards(self):
+        with tempfile.TemporaryDirectory() as folder:
+            Image.new("RGB", (160, 240), "red").save("%s/wp1.jpg" % folder)
+            bundle = ZipBundle("%s/route.zip" % folder)
+            bundle.add_notes("A\n")
+            bundle.add_board("%s/wp1.jpg" % folder)
+            bundle.close()
+            with zipfile.ZipFile("%s/route.zip" % folder) as archive:
+                self.assertEqual(archive.namelist(), ["notes.txt", "wp1.jpg"])
+
+
+if __name__ == '__main__':
+    unittest.main()
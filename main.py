@@ -1,31 +1,258 @@
-import sys
+import argparse
 import os
-from route import Route
-from map_file import find_map_from_wp
+import time
+import traceback
+from bundle import bundle_formats, open_bundle
+from memory_budget import plan_memory
+from route import Route, board_formats, board_resamples, overview_modes
 from tot_planner import parse_time
+from profiler import Profiler, get_peak_rss_mb, get_peak_workers_rss_mb, profiling_requested
 
 
 def main():
-    route_name = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Generate dead reckoning kneeboards for a route")
+    parser.add_argument("route_name")
+    # Either ToT alone or Start Time and ToT
+    parser.add_argument("times", nargs="*", help="[start time] [ToT] as hours:minutes:seconds")
+    parser.add_argument("--jobs", type=int, default=1, help="number of boards to render in parallel")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write per stage timings and memory use to profile.json, also enabled by KNEEBOARD_PROFILE=1"
+    )
+    parser.add_argument("--force", action="store_true", help="render every board, even those unchanged since the last run")
+    add_output_arguments(parser)
+    add_timing_arguments(parser)
+    parser.add_argument(
+        "--notes-only",
+        action="store_true",
+        help="write notes.txt and print the leg plan without rendering any boards"
+    )
+    parser.add_argument("--watch", action="store_true", help="render again every time the route file is saved")
+    parser.add_argument("--interval", type=float, default=1, help="seconds between checks of the route file in --watch")
+    args = parser.parse_args()
+
+    route_name = args.route_name
     route_file = "./routes/%s.csv" % route_name
-    # Args 2 and 3 are either ToT and blank or Start Time and ToT
     start_time = (0, 0, 0)
     time_on_target = None
-    if len(sys.argv) > 3:
-        start_time = parse_time(sys.argv[2])
-        time_on_target = parse_time(sys.argv[3])
-    if len(sys.argv) > 2:
-        time_on_target = parse_time(sys.argv[2])
+    if len(args.times) > 2:
+        parser.error("expected at most a start time and a ToT")
+    if len(args.times) == 2:
+        start_time = parse_time(args.times[0])
+        time_on_target = parse_time(args.times[1])
+    if len(args.times) == 1:
+        time_on_target = parse_time(args.times[0])
     if not os.path.exists(route_file):
         raise Exception("%s route file not found" % route_name)
 
-    route = Route(route_name, start_time, time_on_target)
+    profile = args.profile or profiling_requested()
+    output = get_output_options(args)
+    timing = get_timing_options(args)
+    if args.notes_only:
+        write_route_notes(route_name, start_time, time_on_target, **timing)
+    elif args.watch:
+        watch_route(
+            route_name, start_time, time_on_target, args.jobs, profile, args.force, args.interval, {**output, **timing}
+        )
+    else:
+        render_route(route_name, start_time, time_on_target, args.jobs, profile, force=args.force, **output, **timing)
+        print_peak_memory(args.max_memory)
+
+
+def add_output_arguments(parser):
+    parser.add_argument("--format", choices=sorted(board_formats.keys()), default="jpg", help="board image format")
+    parser.add_argument("--quality", type=int, help="JPEG or WebP quality from 1 to 100")
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        help="MB to stay within, choosing how boards are rendered to fit and failing early if they can't"
+    )
+    parser.add_argument(
+        "--encode-threads",
+        type=int,
+        default=1,
+        help="threads resizing and saving boards while the next ones are drawn, 0 to do it in turn"
+    )
+    parser.add_argument(
+        "--overview",
+        choices=overview_modes,
+        default="full",
+        help="overview of the whole cropped map, of the route shrunk to --overview-size, or that and tiles at full detail"
+    )
+    parser.add_argument("--overview-size", type=int, default=2400, help="longest side in pixels of a route overview")
+    parser.add_argument(
+        "--resample",
+        choices=sorted(board_resamples.keys()),
+        help="cut each board out with one resampling of the map rather than rotating, cropping and resizing it in turn, "
+             "nearest being quickest for drafts"
+    )
+    parser.add_argument(
+        "--bundle",
+        choices=sorted(bundle_formats.keys()),
+        help="also gather the notes, boards and overview into one <route>.pdf or <route>.zip as the boards are saved"
+    )
+
+
+def get_output_options(args):
+    if args.quality is not None and not 1 <= args.quality <= 100:
+        raise Exception("quality must be from 1 to 100")
+    return {
+        "board_format": args.format,
+        "board_quality": args.quality,
+        "encode_threads": args.encode_threads,
+        "max_memory": args.max_memory,
+        "overview_mode": args.overview,
+        "overview_size": args.overview_size,
+        "board_resample": args.resample,
+        "bundle_format": args.bundle
+    }
+
+
+def add_timing_arguments(parser):
+    parser.add_argument("--min-cruise", type=int, default=300, help="slowest cruise speed in knots, held at if early")
+    parser.add_argument("--max-cruise", type=int, default=560, help="fastest cruise speed in knots")
+    parser.add_argument(
+        "--speed-ladder",
+        action="store_true",
+        help="pick the cruise speed from the fixed 240 to 560kts options rather than solving for it exactly"
+    )
+
+
+def get_timing_options(args):
+    return {
+        "min_cruise_speed": args.min_cruise,
+        "max_cruise_speed": args.max_cruise,
+        "speed_ladder": args.speed_ladder
+    }
+
+
+def print_peak_memory(max_memory):
+    if max_memory is not None:
+        # Board workers run alongside this process, so their peaks are added to its own. Pages they share with it
+        # are counted in each, so this can only be over what was held at once
+        print("Peak memory: %s MB of %s MB" % (round(get_peak_rss_mb() + get_peak_workers_rss_mb()), max_memory))
+
+
+# Returns the flight notes and the file names of the boards written
+def render_route(
+        route_name,
+        start_time=(0, 0, 0),
+        time_on_target=None,
+        jobs=1,
+        profile=False,
+        waypoints=None,
+        force=False,
+        board_format="jpg",
+        board_quality=None,
+        encode_threads=1,
+        max_memory=None,
+        min_cruise_speed=300,
+        max_cruise_speed=560,
+        speed_ladder=False,
+        overview_mode="full",
+        overview_size=2400,
+        board_resample=None,
+        bundle_format=None
+):
+    profiler = Profiler(profile)
+    route = Route(
+        route_name,
+        start_time,
+        time_on_target,
+        profiler,
+        waypoints,
+        board_format,
+        board_quality,
+        min_cruise_speed,
+        max_cruise_speed,
+        speed_ladder,
+        overview_mode,
+        overview_size,
+        board_resample
+    )
+    if max_memory is not None:
+        # Planned before the map is decoded, so a route that can't fit fails straight away
+        plan = plan_memory(route, max_memory, jobs, encode_threads)
+        print("Memory plan: %s" % plan.describe())
+        route.set_memory_plan(plan)
+        jobs = plan.jobs
     if not os.path.exists("./" + route_name):
         os.mkdir("./" + route_name)
+    notes = route.write_flight_notes()
     with open("./%s/notes.txt" % route_name, "w") as f:
-        f.write(route.write_flight_notes())
-    route.save_boards()
+        f.write(notes)
+    bundle = None
+    if bundle_format is not None:
+        bundle = open_bundle("./%s/%s.%s" % (route_name, route_name, bundle_format), bundle_format)
+        bundle.add_notes(notes)
+    try:
+        board_names = route.save_boards(jobs, force, encode_threads, bundle)
+    except BaseException:
+        # A bundle missing boards is never left behind
+        if bundle is not None:
+            bundle.discard()
+        raise
+    if bundle is not None:
+        bundle.close()
+    if profiler.enabled:
+        profiler.write_report("./%s/profile.json" % route_name)
+    return notes, board_names
+
 
+def write_route_notes(
+        route_name, start_time=(0, 0, 0), time_on_target=None, min_cruise_speed=300, max_cruise_speed=560, speed_ladder=False
+):
+    # The map's pixels are never opened, so this only costs the route's parsing and timing
+    route = Route(
+        route_name,
+        start_time,
+        time_on_target,
+        min_cruise_speed=min_cruise_speed,
+        max_cruise_speed=max_cruise_speed,
+        speed_ladder=speed_ladder
+    )
+    if not os.path.exists("./" + route_name):
+        os.mkdir("./" + route_name)
+    notes = route.write_flight_notes()
+    with open("./%s/notes.txt" % route_name, "w") as f:
+        f.write(notes)
+    print(notes)
+    for index in range(len(route.waypoints)):
+        print("  ".join(map(lambda line: "%s %s" % line, route.get_doghouse_lines(index))))
+    return notes
+
+
+def get_route_file_stamp(route_file):
+    # None while the file is missing, as it can be for a moment when an editor saves by replacing it
+    try:
+        stat = os.stat(route_file)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def watch_route(route_name, start_time, time_on_target, jobs, profile, force, interval, output):
+    # The map stays decoded between renders and the board manifest limits each one to the boards that changed
+    route_file = "./routes/%s.csv" % route_name
+    stamp = None
+    print("Watching %s, Ctrl+C to stop" % route_file)
+    try:
+        while True:
+            new_stamp = get_route_file_stamp(route_file)
+            if new_stamp is not None and new_stamp != stamp:
+                stamp = new_stamp
+                try:
+                    render_route(route_name, start_time, time_on_target, jobs, profile, force=force, **output)
+                except Exception:
+                    # A half edited route shouldn't end the watch, the next save is rendered as usual
+                    traceback.print_exc()
+                # Only the first render is forced
+                force = False
+                print("Waiting for changes to %s" % route_file)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == '__main__':
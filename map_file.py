@@ -1,7 +1,28 @@
+import atexit
 import csv
+import json
 import math
+import numpy as np
 from PIL import Image
 import os
+import tempfile
+import threading
+import unittest
+from map_raw import open_raw_image, open_raw_map, raw_is_current, write_raw_image
+from map_tiles import TileReader, tiles_are_current
+from profiler import Profiler
+
+map_index_filename = "./data/map_index.json"
+# dict - string - dict
+# theatre name, its map.csv stamp, lat/long bounds and coordinate map, see get_map_index
+map_index = None
+# dict - (number, number) - string
+# (lat, long) whole degree cell, name of the first theatre covering it
+map_cells = None
+# dict - string - MapRaster
+# rasters opened so far in this process, see get_map_raster
+map_rasters = {}
+map_rasters_lock = threading.Lock()
 
 
 class MapFile:
@@ -14,11 +35,42 @@ class MapFile:
     coordinate_map = None
     mag_var = 0
     angle_off_north = None
+    # MapRaster
+    raster = None
+    profiler = None
+    # dict - (number, number) - ((number, number), (number, number), (number, number))
+    # (lat, long) whole degree cell, (start pixels, pixels per degree lat, pixels per degree long)
+    cell_transforms = None
+    # numpy array - the same per cell, rows of
+    # (start x, start y, lat x, lat y, long x, long y), indexed from (lowest lat, lowest long), NaN where unusable
+    cell_table = None
+    # (number, number)
+    # (lat, long) of cell_table[0, 0]
+    cell_table_origin = None
 
     def __init__(self, dcs_map_name):
         self.name = dcs_map_name
         self.filename = "./data/%s/map.jpg" % dcs_map_name
-        self.coordinate_map = import_pixel_map(dcs_map_name)
+        self.coordinate_map = get_map_index()[dcs_map_name]["coordinate_map"]
+        self.set_cell_transforms()
+        self.profiler = Profiler()
+
+    def set_cell_transforms(self):
+        # The multipliers only depend on the whole degrees of a point, so they are worked out once per cell
+        self.cell_transforms = {}
+        for (lat_d, long_d) in self.coordinate_map.keys():
+            try:
+                (lat_multipliers, long_multipliers) = self.get_translation_multipliers_for((lat_d, 0, 0), (long_d, 0, 0))
+            except KeyError:
+                # A cell missing a neighbour can't be converted, get_pixels_for raises KeyError for it as before
+                continue
+            self.cell_transforms[(lat_d, long_d)] = (self.coordinate_map[(lat_d, long_d)], lat_multipliers, long_multipliers)
+
+        ((lat_min, lat_max), (long_min, long_max)) = get_pixel_map_lat_long_bounds(self.coordinate_map)
+        self.cell_table_origin = (lat_min, long_min)
+        self.cell_table = np.full((lat_max - lat_min + 1, long_max - long_min + 1, 6), np.nan)
+        for ((lat_d, long_d), (start, lat_multipliers, long_multipliers)) in self.cell_transforms.items():
+            self.cell_table[lat_d - lat_min, long_d - long_min] = start + lat_multipliers + long_multipliers
 
     def get_angle_off_north(self, lat, long):
         (lat_1, _, _) = lat
@@ -34,11 +86,23 @@ class MapFile:
     def get_map_image(self):
         return Image.open("./data/%s/map.jpg" % self.name)
 
+    def get_raster(self):
+        # Opened on first use, so work that never needs pixels, like flight notes, never touches map.jpg
+        if self.raster is None:
+            self.raster = get_map_raster(self.name)
+        return self.raster
+
+    def get_size(self):
+        return self.get_raster().get_size()
+
+    # box is in pixels of the given level, which has 1/2**level of the map's resolution, and must lie within it
+    def get_region(self, box, level=0):
+        return self.get_raster().get_region(box, level, self.profiler)
+
     def get_pixels_for(self, lat, long):
         (lat_d, lat_m, lat_s) = lat
         (long_d, long_m, long_s) = long
-        (start_x, start_y) = self.coordinate_map[(lat[0], long[0])]
-        (lat_multipliers, long_multipliers) = self.get_translation_multipliers_for(lat, long)
+        ((start_x, start_y), lat_multipliers, long_multipliers) = self.cell_transforms[(lat[0], long[0])]
 
         y_offset = (lat_m * lat_multipliers[1] / 60) + \
                    (long_m * long_multipliers[1] / 60) + \
@@ -52,6 +116,44 @@ class MapFile:
 
         return math.floor(start_x + x_offset), math.floor(start_y + y_offset)
 
+    # lats and longs are (n, 3) arrays of degrees, minutes and seconds, or (n,) arrays of decimal degrees,
+    # returns an (n, 2) array of the same pixels get_pixels_for gives for each point
+    def get_pixels_for_many(self, lats, longs):
+        lats = np.asarray(lats, dtype=float)
+        longs = np.asarray(longs, dtype=float)
+        if lats.ndim == 1:
+            lats = np.stack([np.floor(lats), (lats - np.floor(lats)) * 60, np.zeros(len(lats))], axis=1)
+        if longs.ndim == 1:
+            longs = np.stack([np.floor(longs), (longs - np.floor(longs)) * 60, np.zeros(len(longs))], axis=1)
+        (lat_d, lat_m, lat_s) = lats.T
+        (long_d, long_m, long_s) = longs.T
+
+        rows = lat_d.astype(int) - self.cell_table_origin[0]
+        columns = long_d.astype(int) - self.cell_table_origin[1]
+        (row_count, column_count, _) = self.cell_table.shape
+        in_table = (rows >= 0) & (rows < row_count) & (columns >= 0) & (columns < column_count)
+        transforms = self.cell_table[np.where(in_table, rows, 0), np.where(in_table, columns, 0)]
+        unusable = ~in_table | np.isnan(transforms[:, 0])
+        if unusable.any():
+            first = np.argmax(unusable)
+            raise KeyError((int(lat_d[first]), int(long_d[first])))
+
+        # Same operations in the same order as get_pixels_for, so both give identical pixels
+        y_offset = (lat_m * transforms[:, 3] / 60) + \
+                   (long_m * transforms[:, 5] / 60) + \
+                   (lat_s * transforms[:, 3] / 3600) + \
+                   (long_s * transforms[:, 5] / 3600)
+
+        x_offset = (lat_m * transforms[:, 2] / 60) + \
+                   (long_m * transforms[:, 4] / 60) + \
+                   (lat_s * transforms[:, 2] / 3600) + \
+                   (long_s * transforms[:, 4] / 3600)
+
+        return np.stack([
+            np.floor(transforms[:, 0] + x_offset),
+            np.floor(transforms[:, 1] + y_offset)
+        ], axis=1).astype(int)
+
     def get_nearest_lat_long(self, lat, long, inclusive=True, inverted=False):
         available_lats = list(set(map(lambda k: k[0], self.coordinate_map.keys())))
         available_longs = list(set(map(lambda k: k[1], self.coordinate_map.keys())))
@@ -104,29 +206,252 @@ def import_pixel_map(dcs_map_name):
     return output
 
 
+class MapRaster:
+    # Pixels of one theatre's map, opened once per process and shared by every MapFile of that theatre
+    # string
+    name = None
+    # Image - map.jpg, its raw cache, or the raw copy of it once shared, only used when the map has no current tiles
+    img = None
+    # TileReader
+    tiles = None
+    # whether img has been decoded yet
+    decoded = False
+    # whether img maps the map's raw cache built by map_raw.py, and so needs no decoding at all
+    cached = False
+    # string
+    # raw RGBX copy of img that worker processes map read only, see share
+    raw_filename = None
+    # (number, number)
+    # full resolution size, whatever img is decoded at
+    size = None
+    # img is decoded at 1/2**draft_level of full resolution to save memory, see set_draft_level
+    draft_level = 0
+    lock = None
+
+    def __init__(self, dcs_map_name):
+        self.name = dcs_map_name
+        self.lock = threading.Lock()
+        # Pillow only reads the JPEG header here, pixels are decoded on the first region read
+        if raw_is_current(dcs_map_name):
+            self.img = open_raw_map(dcs_map_name)
+            self.size = self.img.size
+            self.decoded = True
+            self.cached = True
+        elif tiles_are_current(dcs_map_name):
+            self.tiles = TileReader(dcs_map_name)
+            self.size = self.tiles.sizes[0]
+        else:
+            self.img = Image.open("./data/%s/map.jpg" % dcs_map_name)
+            self.size = self.img.size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Decoded pixels are far too large to pickle, other processes map raw_filename instead
+        state["img"] = None
+        state["decoded"] = False
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        if self.cached:
+            self.img = open_raw_map(self.name)
+            self.decoded = True
+        elif self.raw_filename is not None:
+            self.img = open_raw_image(self.raw_filename, self.get_draft_size(self.draft_level))
+            self.decoded = True
+
+    def get_size(self):
+        return self.size
+
+    def get_draft_size(self, draft_level):
+        # JPEG decoders scale by rounding up
+        return math.ceil(self.size[0] / 2 ** draft_level), math.ceil(self.size[1] / 2 ** draft_level)
+
+    def set_draft_level(self, draft_level):
+        # Only JPEG's own 1/2, 1/4 and 1/8 scales, and only before the map is decoded. A raw cache is mapped
+        # rather than decoded, so there is nothing to save
+        if self.tiles is not None or self.cached or draft_level == self.draft_level:
+            return
+        if not 0 <= draft_level <= 3:
+            raise Exception("Maps can only be decoded at 1/2, 1/4 or 1/8 resolution")
+        with self.lock:
+            if self.decoded:
+                raise Exception("%s map is already decoded" % self.name)
+            self.img.draft("RGB", self.get_draft_size(draft_level))
+            if self.img.size != self.get_draft_size(draft_level):
+                raise Exception("%s map can't be decoded at 1/%s resolution" % (self.name, 2 ** draft_level))
+            self.draft_level = draft_level
+
+    def get_region(self, box, level, profiler):
+        # Levels beyond the stored ones are reduced from the nearest stored level
+        stored_level = self.draft_level
+        if self.tiles is not None:
+            stored_level = min(level, len(self.tiles.sizes) - 1)
+        if level < stored_level:
+            raise Exception("%s map is only decoded at 1/%s resolution" % (self.name, 2 ** stored_level))
+        factor = 2 ** (level - stored_level)
+        stored_box = tuple(map(lambda i: i * factor, box))
+
+        if self.tiles is None:
+            self.load(profiler)
+            # Reducing straight from the map skips a full size copy of the region
+            if factor > 1:
+                region = self.img.reduce(factor, box=stored_box)
+            else:
+                region = self.img.crop(stored_box)
+            # Raw copies are mapped as RGBX, boards are drawn in RGB
+            if region.mode != "RGB":
+                region = region.convert("RGB")
+            return region
+        region = self.tiles.get_region(stored_box, stored_level)
+        if factor > 1:
+            region = region.reduce(factor)
+        return region
+
+    def load(self, profiler):
+        # Decodes the whole map once, tiles are read as needed instead
+        if self.tiles is None and not self.decoded:
+            with self.lock:
+                if not self.decoded:
+                    with profiler.stage("map decode"):
+                        self.img.load()
+                    self.decoded = True
+
+    def share(self):
+        # Writes the decoded map out once as raw pixels for worker processes to map, then maps it here
+        # as well so the decoded copy can be freed
+        with self.lock:
+            if self.tiles is None and self.raw_filename is None and not self.cached:
+                (handle, raw_filename) = tempfile.mkstemp(suffix=".raw")
+                os.close(handle)
+                write_raw_image(self.img, raw_filename)
+                self.img = open_raw_image(raw_filename, self.img.size)
+                self.decoded = True
+                self.raw_filename = raw_filename
+                atexit.register(self.close)
+        return self.raw_filename
+
+    def close(self):
+        # Anything already mapping the raw copy keeps working after it is removed
+        if self.raw_filename is not None:
+            os.remove(self.raw_filename)
+            self.raw_filename = None
+
+
+def get_map_raster(dcs_map_name):
+    with map_rasters_lock:
+        if dcs_map_name not in map_rasters:
+            map_rasters[dcs_map_name] = MapRaster(dcs_map_name)
+        return map_rasters[dcs_map_name]
+
+
+def release_map_raster(dcs_map_name):
+    # Routes that already hold the raster keep it, the next get_map_raster opens it afresh
+    with map_rasters_lock:
+        raster = map_rasters.pop(dcs_map_name, None)
+    if raster is not None:
+        raster.close()
+
+
 def find_pixel_map_lat_long_bounds(dcs_map_name):
-    pixel_map = import_pixel_map(dcs_map_name)
+    return get_map_index()[dcs_map_name]["bounds"]
+
+
+def get_pixel_map_lat_long_bounds(pixel_map):
     keys = list(pixel_map.keys())
     lat_set = set(map(lambda i: i[0], keys))
     long_set = set(map(lambda i: i[1], keys))
     return (min(lat_set), max(lat_set)), (min(long_set), max(long_set))
 
 
+def get_map_stamp(dcs_map_name):
+    stat = os.stat("./data/%s/map.csv" % dcs_map_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_map_index():
+    # Each map.csv is only parsed again when its size or mtime changes, both between runs via
+    # map_index.json and within a long running process via map_index
+    global map_index, map_cells
+    theatres = list(filter(lambda i: os.path.exists("./data/%s/map.csv" % i), os.listdir("./data")))
+    stamps = dict(map(lambda i: (i, get_map_stamp(i)), theatres))
+    if map_index is not None and stamps == dict(map(lambda i: (i[0], i[1]["stamp"]), map_index.items())):
+        return map_index
+
+    cached = {}
+    if os.path.exists(map_index_filename):
+        with open(map_index_filename) as f:
+            cached = json.load(f)
+
+    index = {}
+    for theatre in theatres:
+        entry = cached.get(theatre)
+        if entry is not None and entry["stamp"] == stamps[theatre]:
+            pixel_map = dict(map(lambda i: ((i[0], i[1]), (i[2], i[3])), entry["grid"]))
+        else:
+            pixel_map = import_pixel_map(theatre)
+        index[theatre] = {
+            "stamp": stamps[theatre],
+            "bounds": get_pixel_map_lat_long_bounds(pixel_map),
+            "coordinate_map": pixel_map
+        }
+
+    stored = dict(map(lambda i: (i[0], {
+        "stamp": i[1]["stamp"],
+        "grid": list(map(lambda j: list(j[0]) + list(j[1]), i[1]["coordinate_map"].items()))
+    }), index.items()))
+    if stored != cached:
+        # Replaced in one step so concurrent runs never read a partly written index
+        with open(map_index_filename + ".tmp", "w") as f:
+            json.dump(stored, f)
+        os.replace(map_index_filename + ".tmp", map_index_filename)
+
+    cells = {}
+    for theatre in theatres:
+        ((lat_min, lat_max), (long_min, long_max)) = index[theatre]["bounds"]
+        for lat_d in range(lat_min, lat_max):
+            for long_d in range(long_min, long_max):
+                cells.setdefault((lat_d, long_d), theatre)
+    map_index = index
+    map_cells = cells
+    return index
+
+
 def find_map_from_wp(lat, long):
     (lat_d, _, _) = lat
     (long_d, _, _) = long
-    data_folders = list(filter(lambda i: i != "routes", os.listdir("./data")))
-    lat_long_bounds = list(map(lambda i: (i, find_pixel_map_lat_long_bounds(i)), data_folders))
-    eligible_bounds = list(
-        filter(
-            lambda i:
-            i[1][0][1] > lat_d >= i[1][0][0] and i[1][1][1] > long_d >= i[1][1][0],
-            lat_long_bounds
+    get_map_index()
+    return map_cells.get((lat_d, long_d))
+
+
+class TestMapFile(unittest.TestCase):
+    def test_pixels_for_many_match_pixels_for(self):
+        test_map = MapFile("caucasus")
+        points = []
+        for (lat_d, long_d) in test_map.cell_transforms.keys():
+            points.append(((lat_d, 0, 0), (long_d, 0, 0)))
+            points.append(((lat_d, 17, 59), (long_d, 42, 3)))
+            points.append(((lat_d, 59, 59), (long_d, 59, 59)))
+        lats = list(map(lambda i: i[0], points))
+        longs = list(map(lambda i: i[1], points))
+        self.assertEqual(
+            list(map(tuple, test_map.get_pixels_for_many(lats, longs).tolist())),
+            list(map(lambda i: test_map.get_pixels_for(i[0], i[1]), points))
         )
-    )
-    if len(eligible_bounds) > 0:
-        return eligible_bounds[0][0]
-    return None
+
+    def test_pixels_for_many_takes_decimal_degrees(self):
+        test_map = MapFile("caucasus")
+        self.assertEqual(
+            tuple(test_map.get_pixels_for_many([42.5], [41.25])[0]),
+            test_map.get_pixels_for((42, 30, 0), (41, 15, 0))
+        )
+
+    def test_pixels_for_many_rejects_points_off_the_map(self):
+        test_map = MapFile("caucasus")
+        with self.assertRaises(KeyError):
+            test_map.get_pixels_for_many([[10, 0, 0]], [[41, 0, 0]])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import mmap
+import os
+import sys
+import tempfile
+import unittest
+import PIL
+from PIL import Image
+PIL.Image.MAX_IMAGE_PIXELS = 10000000000
+
+raw_magic = b"KNEEBOARD RAW 1\n"
+# The header is padded to a whole page so the pixels after it map page aligned
+raw_header_size = 4096
+raw_mode = "RGBX"
+
+
+def get_raw_filename(dcs_map_name):
+    return "./data/%s/map.raw" % dcs_map_name
+
+
+def get_source_filename(dcs_map_name):
+    return "./data/%s/map.jpg" % dcs_map_name
+
+
+def get_source_checksum(filename, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_file_stamp(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def write_raw_image(img, filename, header=None, band_height=256):
+    # RGBX rows can be mapped straight back into an image by open_raw_image without decoding,
+    # after a raw_header_size header when one is given
+    with open(filename, "wb") as f:
+        if header is not None:
+            text = raw_magic + json.dumps(header).encode("utf-8") + b"\n"
+            if len(text) > raw_header_size:
+                raise Exception("raw map header is over %s bytes" % raw_header_size)
+            f.write(text.ljust(raw_header_size, b"\0"))
+        for y in range(0, img.height, band_height):
+            band = img.crop((0, y, img.width, min(y + band_height, img.height)))
+            f.write(band.tobytes("raw", raw_mode))
+
+
+def open_raw_image(filename, size, offset=0):
+    with open(filename, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # The image reads pixels directly from the shared page cache, so it is read only
+    return Image.frombuffer(raw_mode, size, memoryview(buffer)[offset:], "raw", raw_mode, 0, 1)
+
+
+def read_raw_header(filename):
+    # None unless filename is a whole raw map with a header
+    with open(filename, "rb") as f:
+        text = f.read(raw_header_size)
+    if len(text) < raw_header_size or not text.startswith(raw_magic):
+        return None
+    header = json.loads(text[len(raw_magic):].rstrip(b"\0"))
+    (width, height) = header["size"]
+    if header["mode"] != raw_mode or os.path.getsize(filename) != raw_header_size + width * height * 4:
+        return None
+    return header
+
+
+def raw_is_current(dcs_map_name):
+    raw_filename = get_raw_filename(dcs_map_name)
+    if not os.path.exists(raw_filename):
+        return False
+    header = read_raw_header(raw_filename)
+    if header is None:
+        return False
+    # A copied or touched JPEG keeps its checksum, which is only worked out when the stamp has changed
+    source_filename = get_source_filename(dcs_map_name)
+    if header["source_stamp"] == get_file_stamp(source_filename):
+        return True
+    return header["source_checksum"] == get_source_checksum(source_filename)
+
+
+def open_raw_map(dcs_map_name):
+    raw_filename = get_raw_filename(dcs_map_name)
+    header = read_raw_header(raw_filename)
+    return open_raw_image(raw_filename, tuple(header["size"]), raw_header_size)
+
+
+def build_raw(dcs_map_name):
+    source_filename = get_source_filename(dcs_map_name)
+    header = {
+        "source_stamp": get_file_stamp(source_filename),
+        "source_checksum": get_source_checksum(source_filename)
+    }
+    img = Image.open(source_filename)
+    img.load()
+    header["size"] = list(img.size)
+    header["mode"] = raw_mode
+
+    # Replaced in one step so a half written map is never mapped
+    raw_filename = get_raw_filename(dcs_map_name)
+    (handle, temp_filename) = tempfile.mkstemp(suffix=".raw", dir=os.path.dirname(raw_filename))
+    os.close(handle)
+    try:
+        write_raw_image(img, temp_filename, header)
+        # mkstemp leaves the file readable by its owner alone
+        os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, raw_filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+    print("%s raw map complete" % dcs_map_name)
+
+
+class TestMapRaw(unittest.TestCase):
+    def test_raw_image_maps_back_to_the_same_pixels(self):
+        img = Image.effect_noise((301, 517), 64).convert("RGB")
+        with tempfile.TemporaryDirectory() as folder:
+            filename = "%s/map.raw" % folder
+            write_raw_image(img, filename, {"size": list(img.size), "mode": raw_mode}, band_height=100)
+            self.assertEqual(read_raw_header(filename)["size"], [301, 517])
+            mapped = open_raw_image(filename, img.size, raw_header_size)
+            self.assertEqual(mapped.convert("RGB").tobytes(), img.tobytes())
+            with open(filename, "r+b") as f:
+                f.truncate(raw_header_size + 10)
+            self.assertIsNone(read_raw_header(filename))
+
+
+if __name__ == '__main__':
+    map_names = sys.argv[1:]
+    if len(map_names) < 1:
+        map_names = list(filter(lambda i: os.path.isdir("./data/%s" % i), os.listdir("./data")))
+    for map_name in map_names:
+        build_raw(map_name)
@@ -0,0 +1,111 @@
+import json
+import math
+import os
+import sys
+from functools import lru_cache
+import PIL
+from PIL import Image
+PIL.Image.MAX_IMAGE_PIXELS = 10000000000
+
+tile_size = 1024
+# each level halves the resolution of the one before it, level 0 being the source map
+tile_levels = 5
+tile_quality = 95
+
+
+def get_tiles_folder(dcs_map_name):
+    return "./data/%s/tiles" % dcs_map_name
+
+
+def get_source_stamp(dcs_map_name):
+    stat = os.stat("./data/%s/map.jpg" % dcs_map_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def tiles_are_current(dcs_map_name):
+    index_filename = "%s/tiles.json" % get_tiles_folder(dcs_map_name)
+    if not os.path.exists(index_filename):
+        return False
+    with open(index_filename) as f:
+        index = json.load(f)
+    return index["source"] == get_source_stamp(dcs_map_name)
+
+
+def build_tiles(dcs_map_name):
+    folder = get_tiles_folder(dcs_map_name)
+    img = Image.open("./data/%s/map.jpg" % dcs_map_name)
+    sizes = []
+    for level in range(tile_levels):
+        if level > 0:
+            img = img.reduce(2)
+        sizes.append(list(img.size))
+        os.makedirs("%s/%s" % (folder, level), exist_ok=True)
+        for tile_y in range(math.ceil(img.height / tile_size)):
+            for tile_x in range(math.ceil(img.width / tile_size)):
+                tile = img.crop((
+                    tile_x * tile_size,
+                    tile_y * tile_size,
+                    min((tile_x + 1) * tile_size, img.width),
+                    min((tile_y + 1) * tile_size, img.height)
+                ))
+                tile.save(get_tile_filename(dcs_map_name, level, tile_x, tile_y), quality=tile_quality)
+        print("%s level %s tiles complete" % (dcs_map_name, level))
+
+    # Written last so a half built pyramid is never mistaken for a current one
+    with open("%s/tiles.json" % folder, "w") as f:
+        json.dump({
+            "source": get_source_stamp(dcs_map_name),
+            "tile_size": tile_size,
+            "sizes": sizes
+        }, f)
+
+
+def get_tile_filename(dcs_map_name, level, tile_x, tile_y):
+    return "%s/%s/%s_%s.jpg" % (get_tiles_folder(dcs_map_name), level, tile_x, tile_y)
+
+
+@lru_cache(maxsize=32)
+def read_tile(filename):
+    tile = Image.open(filename)
+    tile.load()
+    return tile
+
+
+class TileReader:
+    # string
+    name = None
+    tile_size = None
+    # list - (number, number)
+    # pixel size of the map at each level
+    sizes = None
+
+    def __init__(self, dcs_map_name):
+        self.name = dcs_map_name
+        with open("%s/tiles.json" % get_tiles_folder(dcs_map_name)) as f:
+            index = json.load(f)
+        self.tile_size = index["tile_size"]
+        self.sizes = list(map(tuple, index["sizes"]))
+
+    # box is in pixels of the given level, anything off the map comes back black
+    def get_region(self, box, level=0):
+        (x_min, y_min, x_max, y_max) = box
+        (width, height) = self.sizes[level]
+        img = Image.new("RGB", (x_max - x_min, y_max - y_min))
+
+        first_x = max(x_min, 0) // self.tile_size
+        first_y = max(y_min, 0) // self.tile_size
+        last_x = (min(x_max, width) - 1) // self.tile_size
+        last_y = (min(y_max, height) - 1) // self.tile_size
+        for tile_y in range(first_y, last_y + 1):
+            for tile_x in range(first_x, last_x + 1):
+                tile = read_tile(get_tile_filename(self.name, level, tile_x, tile_y))
+                img.paste(tile, (tile_x * self.tile_size - x_min, tile_y * self.tile_size - y_min))
+        return img
+
+
+if __name__ == '__main__':
+    map_names = sys.argv[1:]
+    if len(map_names) < 1:
+        map_names = list(filter(lambda i: os.path.isdir("./data/%s" % i), os.listdir("./data")))
+    for map_name in map_names:
+        build_tiles(map_name)
@@ -0,0 +1,138 @@
+import math
+from map_tiles import read_tile, tile_size
+from profiler import get_current_rss_mb
+from route import board_output_size, max_cached_overlays
+
+# bytes Pillow keeps per pixel of an RGB image
+rgb_pixel_bytes = 4
+# allowance for each extra board process beyond the pages it shares with the parent
+worker_overhead_mb = 40
+# coarsest resolution maps can be decoded at, as 1/2**level, see MapRaster.set_draft_level
+max_draft_level = 3
+max_overview_level = 6
+
+
+class MemoryPlan:
+    # Strategy for rendering a route within a memory budget, see plan_memory
+    draft_level = 0
+    cache_overlays = True
+    overview_level = 0
+    jobs = 1
+    # estimated peak RSS in MB
+    estimate_mb = None
+
+    def __init__(self, draft_level, cache_overlays, overview_level, jobs):
+        self.draft_level = draft_level
+        self.cache_overlays = cache_overlays
+        self.overview_level = overview_level
+        self.jobs = jobs
+
+    def describe(self):
+        return "%s MB estimated, map decoded at 1/%s, %s job%s, overlays %s, overview at 1/%s" % (
+            math.ceil(self.estimate_mb),
+            2 ** self.draft_level,
+            self.jobs,
+            "" if self.jobs == 1 else "s",
+            "kept between boards" if self.cache_overlays else "drawn per board",
+            2 ** self.overview_level
+        )
+
+
+def to_mb(size):
+    return size / (1024 * 1024)
+
+
+def get_raster_mb(raster, draft_level):
+    if raster.tiles is not None:
+        # every tile read_tile may keep
+        return to_mb(read_tile.cache_info().maxsize * tile_size ** 2 * rgb_pixel_bytes)
+    if raster.decoded:
+        # already part of the current RSS, or mapped from the raw cache and only read in as boards need it
+        return 0
+    (width, height) = raster.get_draft_size(draft_level)
+    return to_mb(width * height * rgb_pixel_bytes)
+
+
+def get_board_mb(route, index, level, encode_threads):
+    # The board's region, its copy for rotating and the rotated result, its focus and overlay masks,
+    # then the cropped board and the output
+    region = route.get_board_region(index, level)
+    region_area = (region[2] - region[0]) * (region[3] - region[1])
+    (board_width, board_height) = route.kneeboard_width_for_wp_index(index)
+    board_area = board_width * board_height / 4 ** level
+    output_area = board_output_size[0] * board_output_size[1]
+    if route.board_resample is not None:
+        # Transformed straight from the region to the output, see Route.transform_board_for_wp
+        board_area = 0
+        size = region_area * (rgb_pixel_bytes + 2) + output_area * rgb_pixel_bytes
+    else:
+        size = region_area * (rgb_pixel_bytes * 3 + 2) + board_area * rgb_pixel_bytes + output_area * rgb_pixel_bytes
+    # Boards waiting on the encode threads, see Route.save_boards_pipelined
+    size += encode_threads * 2 * (board_area + output_area) * rgb_pixel_bytes
+    return to_mb(size)
+
+
+def get_overlays_mb(route, levels):
+    # The largest overlays the boards can keep at once, one per symbol size and map level shared between boards
+    boxes = set()
+    for key in route.get_shared_overlay_keys(levels):
+        boxes.add(route.get_route_overlay_box(*key))
+    areas = sorted(map(lambda box: (box[2] - box[0]) * (box[3] - box[1]), boxes), reverse=True)
+    return to_mb(sum(areas[:max_cached_overlays]))
+
+
+def get_overview_mb(route, level):
+    region = route.get_overview_region(level)
+    area = (region[2] - region[0]) * (region[3] - region[1])
+    if route.overview_mode == "tiled":
+        # Tiles are drawn one at a time at no coarser a level than the overview
+        area = max(area, tile_size ** 2)
+    # The map and the region read into it, its overlay and focus masks
+    return to_mb(area * (rgb_pixel_bytes * 2 + 2))
+
+
+def estimate_peak_mb(route, plan, encode_threads, base_mb):
+    levels = list(map(lambda i: max(route.get_board_level(i), plan.draft_level), range(len(route.waypoints))))
+    # Boards in worker processes are saved as they are drawn
+    if plan.jobs > 1:
+        encode_threads = 0
+    board_mb = max(map(lambda i: get_board_mb(route, i, levels[i], encode_threads), range(len(route.waypoints))))
+    overlays_mb = get_overlays_mb(route, levels) if plan.cache_overlays else 0
+    overview_mb = get_overview_mb(route, max(route.get_overview_scaled_level(), plan.overview_level, plan.draft_level))
+    if plan.jobs > 1:
+        # Each worker keeps its own overlays, which go with it before the overview is drawn
+        board_mb = (board_mb + overlays_mb + worker_overhead_mb) * plan.jobs
+    else:
+        board_mb += overlays_mb
+        overview_mb += overlays_mb
+    return base_mb + get_raster_mb(route.map.get_raster(), plan.draft_level) + max(board_mb, overview_mb)
+
+
+def get_draft_levels(raster):
+    if raster.tiles is not None:
+        return [0]
+    if raster.decoded:
+        # Too late to decode it any smaller
+        return [raster.draft_level]
+    return list(range(max_draft_level + 1))
+
+
+def plan_memory(route, max_memory_mb, jobs=1, encode_threads=1):
+    # The first plan estimated to fit, giving up parallelism and overlay caching before overview resolution,
+    # and overview resolution before board resolution
+    base_mb = get_current_rss_mb() or 0
+    lowest = None
+    for draft_level in get_draft_levels(route.map.get_raster()):
+        for overview_level in range(draft_level, max_overview_level + 1):
+            for plan_jobs in range(max(jobs, 1), 0, -1):
+                for cache_overlays in (True, False):
+                    plan = MemoryPlan(draft_level, cache_overlays, overview_level, plan_jobs)
+                    plan.estimate_mb = estimate_peak_mb(route, plan, encode_threads, base_mb)
+                    if plan.estimate_mb <= max_memory_mb:
+                        return plan
+                    if lowest is None or plan.estimate_mb < lowest.estimate_mb:
+                        lowest = plan
+    raise Exception(
+        "%s needs an estimated %s MB even at its lowest (%s), over the %s MB budget" %
+        (route.name, math.ceil(lowest.estimate_mb), lowest.describe(), max_memory_mb)
+    )
@@ -0,0 +1,116 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+profile_environment_variable = "KNEEBOARD_PROFILE"
+# largest sum of the peak RSS of a pool of board workers, see add_worker_pool_peaks
+peak_workers_rss_mb = 0
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def add_worker_pool_peaks(peaks):
+    # peaks - dict - number - number
+    # worker process id, its peak RSS in MB, for one pool of board workers that ran alongside each other
+    global peak_workers_rss_mb
+    peak_workers_rss_mb = max(peak_workers_rss_mb, sum(peaks.values()))
+
+
+def get_peak_workers_rss_mb():
+    return peak_workers_rss_mb
+
+
+def get_current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        return None
+
+
+def profiling_requested():
+    return os.environ.get(profile_environment_variable, "") not in ("", "0")
+
+
+class Profiler:
+    enabled = False
+    # list - dict
+    # one record per timed stage, in the order they finished
+    records = None
+    started = None
+    lock = None
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, board=None):
+        if not self.enabled:
+            yield
+            return
+        peak_before = get_peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak_after = get_peak_rss_mb()
+            record = {
+                "stage": name,
+                "seconds": seconds,
+                "peak_rss_mb": peak_after,
+                # How far this stage pushed the process's peak up, 0 if it stayed under an earlier peak
+                "peak_rss_growth_mb": peak_after - peak_before,
+                "rss_mb": get_current_rss_mb(),
+                "pid": os.getpid()
+            }
+            if board is not None:
+                record["board"] = board
+            with self.lock:
+                self.records.append(record)
+
+    def take_records(self):
+        # Hands back and forgets what has been recorded so far, for passing records between processes
+        with self.lock:
+            (records, self.records) = (self.records, [])
+        return records
+
+    def add_records(self, records):
+        with self.lock:
+            self.records.extend(records)
+
+    def get_report(self):
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["stage"], {"seconds": 0, "count": 0, "peak_rss_mb": 0})
+            total["seconds"] += record["seconds"]
+            total["count"] += 1
+            total["peak_rss_mb"] = max(total["peak_rss_mb"], record["peak_rss_mb"])
+        return {
+            "total_seconds": time.perf_counter() - self.started,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "totals": totals,
+            "stages": self.records
+        }
+
+    def write_report(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.get_report(), f, indent=2)
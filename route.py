@@ -1,11 +1,24 @@
 import csv
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import math
-from waypoint import WayPoint
-from map_file import MapFile, find_map_from_wp
+import multiprocessing
+from functools import lru_cache
+from waypoint import WayPoint, get_leg_geometry
+from map_file import MapFile, find_map_from_wp, get_map_stamp, release_map_raster
+from map_tiles import get_source_stamp, tile_size
 from tot_planner import get_waypoint_times, time_to_minutes
+from profiler import Profiler, add_worker_pool_peaks, get_peak_rss_mb
+from spatial_index import SegmentGrid
 import PIL
-from PIL import ImageDraw, Image, ImageOps
+from PIL import ImageDraw, Image
+import os
+import shutil
+import tempfile
 import time
+import unittest
+import numpy as np
 PIL.Image.MAX_IMAGE_PIXELS = 10000000000
 
 aspect_ratio = 6 / 4
@@ -18,6 +31,32 @@ waypoint_circle_max_rad = 100
 waypoint_circle_max_width = 20
 
 cropping_margin = 8000
+# extra pixels kept around a board's rotation region so edge samples stay inside it
+rotation_margin = 4
+
+board_output_size = (1600, 2400)
+# dict - string - string
+# board file extension, Pillow format it is saved in
+board_formats = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+# longest side in pixels a WebP image can have
+max_webp_size = 16383
+# dict - string - number
+# resampling a board can be cut out with in one pass, see Route.transform_board_for_wp
+board_resamples = {"nearest": PIL.Image.NEAREST, "bilinear": PIL.Image.BILINEAR, "bicubic": PIL.Image.BICUBIC}
+# full draws the whole cropped map at map resolution, route only the route's waypoints and a margin around them
+# shrunk to overview_size, tiled adds a pyramid of tiles of the route at full detail to route
+overview_modes = ("full", "route", "tiled")
+# margin kept around the waypoints on a route overview, as a ratio of the route's longest side
+overview_margin_ratio = 0.1
+overview_min_margin = 1000
+# route overlays kept between boards, each the size of the whole route, the least recently used going first
+max_cached_overlays = 2
+# size of the minute tick numbers on a board drawn at map resolution
+minute_label_font_size = 50
+minute_label_box_size = 55
+
+# Route each board worker process renders from, set up by init_board_worker
+worker_route = None
 
 
 class Route:
@@ -28,22 +67,85 @@ class Route:
     time_on_target = None
     cruise_speed = None
     dash_speed = 500
-
-    def __init__(self, route_name, start_time=(0, 0, 0), time_on_target=None):
-        route_filename = "./routes/%s.csv" % route_name
-
-        with open(route_filename, newline='') as csv_file:
-            reader = csv.reader(csv_file, delimiter=',', quotechar='|')
-            for i, record in enumerate(reader):
-                if i > 0:
-                    self.waypoints.append(WayPoint(record, i-1))
+    min_cruise_speed = 300
+    max_cruise_speed = 560
+    # whether cruise speed is picked from tot_planner.speed_options rather than solved for exactly
+    speed_ladder = False
+    # dict - (number, number, number) - (Image, (number, number))
+    # (circle_radius, line_width, level), (overlay mask, map pixel origin), at most max_cached_overlays of them
+    # from the least to the most recently used
+    overlays = None
+    # one of board_formats
+    board_format = "jpg"
+    # JPEG and WebP quality from 1 to 100, or None for Pillow's default
+    board_quality = None
+    # one of board_resamples, or None to rotate, crop and resize each board in turn
+    board_resample = None
+    # whether route overlays are kept between boards, or drawn for each board's region alone
+    cache_overlays = True
+    # set - (number, number, number)
+    # (circle_radius, line_width, level) of the overlays more than one board shares, see get_shared_overlay_keys
+    shared_overlay_keys = None
+    # map level the overview is drawn at
+    overview_level = 0
+    # SegmentGrid - in map pixels, the leg into each waypoint, or the first waypoint's position
+    leg_index = None
+    # one of overview_modes
+    overview_mode = "full"
+    # longest side in pixels of a route or tiled overview
+    overview_size = 2400
+
+    # waypoints are read from ./routes/<route_name>.csv unless already given
+    def __init__(
+            self,
+            route_name,
+            start_time=(0, 0, 0),
+            time_on_target=None,
+            profiler=None,
+            waypoints=None,
+            board_format="jpg",
+            board_quality=None,
+            min_cruise_speed=300,
+            max_cruise_speed=560,
+            speed_ladder=False,
+            overview_mode="full",
+            overview_size=2400,
+            board_resample=None
+    ):
+        if board_format not in board_formats:
+            raise Exception("Unknown board format %s" % board_format)
+        if board_resample is not None and board_resample not in board_resamples:
+            raise Exception("Unknown board resampling %s" % board_resample)
+        self.board_resample = board_resample
+        if overview_mode not in overview_modes:
+            raise Exception("Unknown overview mode %s" % overview_mode)
+        if overview_size < 1:
+            raise Exception("overview size must be at least 1 pixel")
+        self.overview_mode = overview_mode
+        self.overview_size = overview_size
+        self.board_format = board_format
+        self.board_quality = board_quality
+        self.min_cruise_speed = min_cruise_speed
+        self.max_cruise_speed = max_cruise_speed
+        self.speed_ladder = speed_ladder
+        self.waypoints = []
+        self.profiler = profiler
+        if self.profiler is None:
+            self.profiler = Profiler()
+
+        with self.profiler.stage("csv parse"):
+            if waypoints is None:
+                waypoints = read_route_waypoints(route_name)
+            self.waypoints = waypoints
         if len(self.waypoints) < 1:
             raise Exception("Empty route")
-        dcs_map_name = find_map_from_wp(self.waypoints[0].lat, self.waypoints[0].long)
-        if dcs_map_name is None:
-            raise Exception("No map data for specified route")
+        with self.profiler.stage("map selection"):
+            dcs_map_name = find_map_from_wp(self.waypoints[0].lat, self.waypoints[0].long)
+            if dcs_map_name is None:
+                raise Exception("No map data for specified route")
+            self.map = MapFile(dcs_map_name)
+        self.map.profiler = self.profiler
         self.name = route_name
-        self.map = MapFile(dcs_map_name)
         self.start_time = start_time
         self.time_on_target = time_on_target
         self.set_wp_bearings()
@@ -54,19 +156,49 @@ class Route:
         self.max_y = max(map(lambda wp: wp.y_pixel, self.waypoints))
         self.min_x = min(map(lambda wp: wp.x_pixel, self.waypoints))
         self.min_y = min(map(lambda wp: wp.y_pixel, self.waypoints))
-        self.img = self.map.get_map_image()
+        self.leg_index = SegmentGrid(list(map(
+            lambda i: ((self.waypoints[max(i - 1, 0)].x_pixel, self.waypoints[max(i - 1, 0)].y_pixel),
+                       (self.waypoints[i].x_pixel, self.waypoints[i].y_pixel)),
+            range(len(self.waypoints))
+        )))
+        self.overlays = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Overlays are cheap to redraw compared to pickling them to every worker
+        state["overlays"] = {}
+        return state
 
     def map_wp_pixels(self):
-        for wp in self.waypoints:
-            (x, y) = self.map.get_pixels_for(wp.lat, wp.long)
+        pixels = self.map.get_pixels_for_many(
+            list(map(lambda wp: wp.lat, self.waypoints)),
+            list(map(lambda wp: wp.long, self.waypoints))
+        )
+        for wp, (x, y) in zip(self.waypoints, pixels.tolist()):
             wp.x_pixel = x
             wp.y_pixel = y
 
-    def get_cropped_map_image(self):
-        img = self.img.copy()
-        (x_max, y_max) = img.size
+    def get_cropped_map_size(self):
+        # boards are black beyond this, see get_map_region
+        (x_max, y_max) = self.map.get_size()
+        return min(self.max_x + cropping_margin, x_max), min(self.max_y + cropping_margin, y_max)
 
-        img = img.crop((0, 0, min(self.max_x + cropping_margin, x_max), min(self.max_y + cropping_margin, y_max)))
+    def get_cropped_map_image(self):
+        return self.get_map_region((0, 0) + self.get_cropped_map_size())
+
+    # box is in pixels of the given map level, which has 1/2**level of the map's resolution
+    def get_map_region(self, box, level=0):
+        # Same pixels as cropping get_cropped_map_image to box, without reading the whole map first
+        (x_max, y_max) = self.get_cropped_map_size()
+        (x_max, y_max) = (x_max // 2 ** level, y_max // 2 ** level)
+
+        visible = (max(box[0], 0), max(box[1], 0), min(box[2], x_max), min(box[3], y_max))
+        if visible == tuple(box):
+            # Nothing off the map to leave black, so the region is already a copy of its own
+            return self.map.get_region(visible, level)
+        img = Image.new("RGB", (box[2] - box[0], box[3] - box[1]))
+        if visible[0] < visible[2] and visible[1] < visible[3]:
+            img.paste(self.map.get_region(visible, level), (visible[0] - box[0], visible[1] - box[1]))
         return img
 
     def set_map_magvar(self):
@@ -85,21 +217,25 @@ class Route:
                 return
 
     def set_wp_bearings(self):
-        for wp in self.waypoints:
-            if wp.index > 0:
-                prev = self.waypoints[wp.index-1]
-                wp.bearing_from_last = wp.bearing_from(prev)
-                wp.distance_from_last = wp.distance_from(prev)
-            if wp.index < len(self.waypoints)-1:
-                next_wp = self.waypoints[wp.index + 1]
-                wp.bearing_to_next = next_wp.bearing_from(wp)
+        # Worked out once for every leg, boards and notes use these rather than the waypoints' own methods
+        (bearings, distances) = get_leg_geometry(self.waypoints)
+        for i in range(1, len(self.waypoints)):
+            self.waypoints[i].bearing_from_last = bearings[i - 1]
+            self.waypoints[i].distance_from_last = distances[i - 1]
+            self.waypoints[i - 1].bearing_to_next = bearings[i - 1]
 
     def set_tot_times(self):
-        [target_wp] = [x for x in self.waypoints if "TGT" in x.tags]
-        timed_route = self.waypoints[0:target_wp.index+1]
-
-        distances = list(map(lambda wp: wp.distance_from_last, timed_route))
-        (times, speed) = get_waypoint_times(distances, self.start_time, self.time_on_target, self.dash_speed)
+        # The legs' distances from set_wp_bearings
+        distances = get_timed_distances(self.waypoints, list(map(lambda wp: wp.distance_from_last, self.waypoints[1:])))
+        (times, speed) = get_waypoint_times(
+            distances,
+            self.start_time,
+            self.time_on_target,
+            self.dash_speed,
+            self.min_cruise_speed,
+            self.max_cruise_speed,
+            self.speed_ladder
+        )
         self.cruise_speed = speed
         for i, time in enumerate(times):
             if i <= len(self.waypoints):
@@ -125,11 +261,12 @@ class Route:
 
         return width * margin_ratio, height * margin_ratio
 
-    def draw_for_wp_index(self, index, draw, circle_radius, line_width, is_focused):
+    # draws onto an 'L' mask at scale times map resolution, whose top left corner sits at origin in those pixels
+    def draw_for_wp_index(self, index, draw, circle_radius, line_width, is_focused, origin=(0, 0), scale=1):
         wp = self.waypoints[index]
         # (x_cur, y_cur) = self.map.get_pixels_for(wp.lat, wp.long)
-        x_cur = wp.x_pixel
-        y_cur = wp.y_pixel
+        x_cur = wp.x_pixel * scale - origin[0]
+        y_cur = wp.y_pixel * scale - origin[1]
         is_ip = "IP" in wp.tags
         is_tgt = "TGT" in wp.tags
         alpha = 150
@@ -145,7 +282,7 @@ class Route:
                     (x_cur, y_cur, circle_radius),
                     3,
                     120 + self.map.get_angle_off_north(wp.lat, wp.long) - wp.bearing_from_last,
-                    outline=(0, 0, 0, alpha),
+                    outline=alpha,
                     width=line_width
                 )
             if is_ip:
@@ -153,7 +290,7 @@ class Route:
                     (x_cur, y_cur, circle_radius),
                     4,
                     self.map.get_angle_off_north(wp.lat, wp.long) - wp.bearing_from_last,
-                    outline=(0, 0, 0, alpha),
+                    outline=alpha,
                     width=line_width
                 )
         else:
@@ -162,14 +299,19 @@ class Route:
                     (x_cur - circle_radius, y_cur - circle_radius),
                     (x_cur + circle_radius, y_cur + circle_radius)
                 ),
-                outline=(0, 0, 0, alpha),
+                outline=alpha,
                 width=line_width
             )
 
-    def draw_route_for_wp_from_prev(self, img, index, draw, circle_radius, line_width, is_focused):
+    # draws onto an 'L' mask at scale times map resolution, whose top left corner sits at origin in those pixels
+    def draw_route_for_wp_from_prev(
+            self, img, index, draw, circle_radius, line_width, is_focused, origin=(0, 0), scale=1
+    ):
         if index > 0:
             wp = self.waypoints[index]
             prev = self.waypoints[index-1]
+            (x, y) = (wp.x_pixel * scale - origin[0], wp.y_pixel * scale - origin[1])
+            (x_prev, y_prev) = (prev.x_pixel * scale - origin[0], prev.y_pixel * scale - origin[1])
 
             wp_radius = circle_radius
             if "TGT" in wp.tags:
@@ -184,21 +326,21 @@ class Route:
             if is_focused:
                 alpha = 255
 
-            angle = math.atan2(prev.y_pixel - wp.y_pixel, prev.x_pixel - wp.x_pixel)
+            angle = math.atan2(y_prev - y, x_prev - x)
 
             draw.line(
                 (
-                    (prev.x_pixel - (circle_radius * math.cos(angle)), prev.y_pixel - (circle_radius * math.sin(angle))),
-                    (wp.x_pixel + (wp_radius * math.cos(angle)), wp.y_pixel + (wp_radius * math.sin(angle)))
+                    (x_prev - (circle_radius * math.cos(angle)), y_prev - (circle_radius * math.sin(angle))),
+                    (x + (wp_radius * math.cos(angle)), y + (wp_radius * math.sin(angle)))
                 ),
-                (0, 0, 0, alpha),
+                alpha,
                 line_width
             )
             if is_focused and wp.time is not None and prev.time is not None:
                 minutes_for_leg = time_to_minutes(wp.time) - time_to_minutes(prev.time)
                 minutes_to_draw = math.floor(minutes_for_leg)
-                minute_x_distance = (prev.x_pixel - wp.x_pixel) / minutes_for_leg
-                minute_y_distance = (prev.y_pixel - wp.y_pixel) / minutes_for_leg
+                minute_x_distance = (x_prev - x) / minutes_for_leg
+                minute_y_distance = (y_prev - y) / minutes_for_leg
 
                 tag_len = line_width * 3
 
@@ -208,29 +350,30 @@ class Route:
                 y_distance = math.floor(math.sin(perp)*tag_len)
 
                 for i in range(1, minutes_to_draw + 1):
-                    x_center = wp.x_pixel + (minute_x_distance * i)
-                    y_center = wp.y_pixel + (minute_y_distance * i)
+                    x_center = x + (minute_x_distance * i)
+                    y_center = y + (minute_y_distance * i)
                     draw.line(
                         (
                             (x_center + x_distance, y_center + y_distance),
                             (x_center - x_distance, y_center - y_distance)
                         ),
-                        (0, 0, 0, 255),
+                        255,
                         math.floor(line_width/2)
                     )
-                    temp = Image.new('L', (55, 55))
-                    d = ImageDraw.Draw(temp)
-                    d.text((0, 0), "%s" % i, fill=255, font_size=50, align="left")
-
                     text_angle = ((360-math.degrees(angle)) + 360 + 90) % 360
                     if 270 > text_angle > 90:
                         direction_invert = -1
 
-                    rot = temp.rotate(text_angle, expand=1)
+                    rot = get_minute_label(
+                        "%s" % i,
+                        round(minute_label_font_size * scale),
+                        math.ceil(minute_label_box_size * scale),
+                        text_angle
+                    )
                     direction_invert = 1
 
                     img.paste(
-                        ImageOps.colorize(rot, (0, 0, 0, 0), (0, 0, 0, 255)),
+                        255,
                         (math.floor((x_center + (x_distance * 2 * direction_invert))), math.floor(y_center + (y_distance * 2 * direction_invert))),
                         rot
                     )
@@ -242,54 +385,186 @@ class Route:
                     #     font_size=50,
                     # )
 
-    def crop_board_for_wp(self, index, img):
+    def get_board_rotation(self, index):
+        # leg midpoint in map pixels and the rotation that puts the leg vertical on the board
+        wp = self.waypoints[index]
+        prev = self.waypoints[index - 1]
+        x_centre = math.floor((wp.x_pixel + prev.x_pixel) / 2)
+        y_centre = math.floor((wp.y_pixel + prev.y_pixel) / 2)
+        bearing_from_prev = math.degrees(math.atan2(wp.y_pixel - prev.y_pixel, wp.x_pixel - prev.x_pixel)) + 90
+        return x_centre, y_centre, bearing_from_prev
+
+    def get_board_level(self, index):
+        # Smallest map level that still has at least output resolution, so boards are only ever shrunk
+        (_, board_height) = self.kneeboard_width_for_wp_index(index)
+        level = 0
+        while board_height / 2 ** (level + 1) >= board_output_size[1]:
+            level += 1
+        # A map decoded at reduced resolution has nothing finer to draw from
+        return max(level, self.map.get_raster().draft_level)
+
+    def get_overview_level(self):
+        return max(self.get_overview_scaled_level(), self.overview_level, self.map.get_raster().draft_level)
+
+    def get_overview_box(self):
+        # map pixels the overview covers
+        (x_max, y_max) = self.get_cropped_map_size()
+        if self.overview_mode == "full":
+            return 0, 0, x_max, y_max
+        margin = max(
+            math.ceil(max(self.max_x - self.min_x, self.max_y - self.min_y) * overview_margin_ratio),
+            overview_min_margin
+        )
+        return (
+            max(math.floor(self.min_x) - margin, 0),
+            max(math.floor(self.min_y) - margin, 0),
+            min(math.ceil(self.max_x) + margin, x_max),
+            min(math.ceil(self.max_y) + margin, y_max)
+        )
+
+    def get_overview_region(self, level):
+        # get_overview_box in pixels of the given map level
+        return tuple(map(lambda i: i // 2 ** level, self.get_overview_box()))
+
+    def get_overview_scaled_level(self):
+        # Smallest map level that still has the overview's output size, so a route overview is only ever shrunk
+        level = 0
+        if self.overview_mode != "full":
+            box = self.get_overview_box()
+            longest = max(box[2] - box[0], box[3] - box[1])
+            while longest / 2 ** (level + 1) >= self.overview_size:
+                level += 1
+        if self.board_format == "webp":
+            # Drawn at a coarser level until it fits in a WebP image
+            region = self.get_overview_region(level)
+            while max(region[2] - region[0], region[3] - region[1]) > max_webp_size:
+                level += 1
+                region = self.get_overview_region(level)
+        return level
+
+    def get_overview_symbol_size(self, index, level, scale):
+        # Symbols keep the size they have on the map, as in a full overview or its tiles, so they shrink with the
+        # overview rather than covering its legs. scale is output pixels per pixel of the given map level
+        (circle_radius, line_width) = self.get_symbol_size(index, level)
+        # Lines stay at least a pixel wide once shrunk
+        return circle_radius, max(line_width, math.ceil(1 / scale))
+
+    def set_memory_plan(self, plan):
+        self.map.get_raster().set_draft_level(plan.draft_level)
+        self.cache_overlays = plan.cache_overlays
+        self.overview_level = plan.overview_level
+        # Board levels follow the draft level
+        self.shared_overlay_keys = None
+
+    def get_board_region(self, index, level=0):
+        # pixel box at the given map level holding everything crop_board_for_wp needs to cut out this board
         wp = self.waypoints[index]
-        # (x, y) = self.map.get_pixels_for(wp.lat, wp.long)
-        x = wp.x_pixel
-        y = wp.y_pixel
         (board_width, board_height) = self.kneeboard_width_for_wp_index(index)
-        local_img = img
         if index > 0:
-            prev = self.waypoints[index - 1]
-            # (x_prev, y_prev) = self.map.get_pixels_for(prev.lat, prev.long)
-
-            x_centre = math.floor((x + prev.x_pixel) / 2)
-            y_centre = math.floor((y + prev.y_pixel) / 2)
-
-            bearing_from_prev = math.degrees(math.atan2(y - prev.y_pixel, x - prev.x_pixel)) + 90
-
-            local_img = img.rotate(bearing_from_prev, center=(x_centre, y_centre))
+            (x_centre, y_centre, _) = self.get_board_rotation(index)
+            # Only the square the rotated board can sweep through is rotated, rather than the whole map
+            region_radius = math.ceil(math.sqrt(board_width ** 2 + board_height ** 2) / 2) + rotation_margin
+            box = (
+                x_centre - region_radius,
+                y_centre - region_radius,
+                x_centre + region_radius,
+                y_centre + region_radius
+            )
+        else:
+            box = tuple(map(round, (
+                wp.x_pixel - (board_width / 2),
+                wp.y_pixel - (board_height / 2),
+                wp.x_pixel + (board_width / 2),
+                wp.y_pixel + (board_height / 2)
+            )))
+
+        factor = 2 ** level
+        return (
+            math.floor(box[0] / factor),
+            math.floor(box[1] / factor),
+            math.ceil(box[2] / factor),
+            math.ceil(box[3] / factor)
+        )
 
-            return local_img.crop((
+    # img may be the whole map or just the board's region at the given map level,
+    # with its top left corner at origin in that level's pixels
+    def crop_board_for_wp(self, index, img, origin=(0, 0), level=0):
+        scale = 1 / 2 ** level
+        (board_width, board_height) = self.kneeboard_width_for_wp_index(index)
+        (board_width, board_height) = (board_width * scale, board_height * scale)
+        (region_x, region_y, region_x_max, region_y_max) = self.get_board_region(index, level)
+        local_img = img.crop((
+            region_x - origin[0],
+            region_y - origin[1],
+            region_x_max - origin[0],
+            region_y_max - origin[1]
+        ))
+        if index > 0:
+            (x_centre, y_centre, bearing_from_prev) = self.get_board_rotation(index)
+            (x_centre, y_centre) = (x_centre * scale, y_centre * scale)
+            with self.profiler.stage("rotate", index):
+                local_img = local_img.rotate(bearing_from_prev, center=(x_centre - region_x, y_centre - region_y))
+
+            # Round in map coordinates so the board lands on the same pixels as a full map rotate. Pillow rotates
+            # with fixed point sample positions counted from the image's corner, so a region and the full map can
+            # still pick the neighbouring map pixel where a position lies within 1/32 of a pixel of an edge
+            (x_min, y_min, x_max, y_max) = map(round, (
                 x_centre - board_width / 2,
                 y_centre - board_height / 2,
                 x_centre + board_width / 2,
                 y_centre + board_height / 2
             ))
+            return local_img.crop((x_min - region_x, y_min - region_y, x_max - region_x, y_max - region_y))
 
-        return img.crop((
-            x - (board_width / 2),
-            y - (board_height / 2),
-            x + (board_width / 2),
-            y + (board_height / 2)
-        ))
+        return local_img
 
-    def add_doghouse_for_wp(self, index, img):
-        wp = self.waypoints[index]
-        draw = ImageDraw.Draw(img, 'RGBA')
-        font_height = get_font_size(img)
-
-        margin = math.floor(font_height * 0.5)
+    # img as for crop_board_for_wp, gives the board at board_output_size having rotated, cropped and resized it
+    # as a single affine transform, so each output pixel is sampled once
+    def transform_board_for_wp(self, index, img, origin=(0, 0), level=0):
+        scale = 1 / 2 ** level
+        window = self.get_board_region(index, level)
+        rotation = (0, 0, 0)
+        if index > 0:
+            (board_width, board_height) = self.kneeboard_width_for_wp_index(index)
+            rotation = self.get_board_rotation(index)
+            # The same window crop_board_for_wp cuts from the rotated region
+            window = tuple(map(round, (
+                rotation[0] * scale - board_width * scale / 2,
+                rotation[1] * scale - board_height * scale / 2,
+                rotation[0] * scale + board_width * scale / 2,
+                rotation[1] * scale + board_height * scale / 2
+            )))
+
+        # Output pixels scale onto the window, which turns about the leg midpoint as Image.rotate turns it
+        # onto img's pixels
+        (scale_x, scale_y) = (
+            (window[2] - window[0]) / board_output_size[0],
+            (window[3] - window[1]) / board_output_size[1]
+        )
+        (x_centre, y_centre) = (rotation[0] * scale - origin[0], rotation[1] * scale - origin[1])
+        (x_offset, y_offset) = (window[0] - origin[0] - x_centre, window[1] - origin[1] - y_centre)
+        angle = -math.radians(rotation[2])
+        (cos, sin) = (math.cos(angle), math.sin(angle))
+        with self.profiler.stage("transform", index):
+            return img.transform(
+                board_output_size,
+                PIL.Image.AFFINE,
+                (
+                    cos * scale_x, sin * scale_y, cos * x_offset + sin * y_offset + x_centre,
+                    -sin * scale_x, cos * scale_y, -sin * x_offset + cos * y_offset + y_centre
+                ),
+                resample=board_resamples[self.board_resample]
+            )
 
+    def get_doghouse_lines(self, index):
+        wp = self.waypoints[index]
         heading = "N/A"
-        if index > 0:
-            prev = self.waypoints[index-1]
-            heading = "%s°" % ((wp.bearing_from(prev)-self.map.mag_var) % 360)
+        if wp.bearing_from_last is not None:
+            heading = "%s°" % ((wp.bearing_from_last-self.map.mag_var) % 360)
         next_heading = "N/A"
 
-        if index < len(self.waypoints)-1:
-            next_wp = self.waypoints[index+1]
-            next_heading = "%s°" % ((next_wp.bearing_from(wp)-self.map.mag_var) % 360)
+        if wp.bearing_to_next is not None:
+            next_heading = "%s°" % ((wp.bearing_to_next-self.map.mag_var) % 360)
 
         distance = "N/A"
         if wp.distance_from_last is not None:
@@ -310,7 +585,7 @@ class Route:
         if wp.min_alt is not None:
             min_alt = f"{wp.min_alt:,}ft"
 
-        lines = [
+        return [
             ("WP:", wp.name),
             ("MC:", heading),
             ("DIST:", distance),
@@ -320,6 +595,14 @@ class Route:
             ("NMC:", next_heading)
         ]
 
+    def add_doghouse_for_wp(self, index, img):
+        draw = ImageDraw.Draw(img, 'RGBA')
+        font_height = get_font_size(img)
+
+        margin = math.floor(font_height * 0.5)
+
+        lines = self.get_doghouse_lines(index)
+
         headings_width = max(map(lambda j: draw.textlength(j[0], font_size=font_height), lines))
         values_width = max(map(lambda j: draw.textlength(j[1], font_size=font_height), lines))
         column_space = img.width * 0.005
@@ -371,76 +654,330 @@ class Route:
             )
         return img
 
-    def create_board_for_wp(self, index):
-        img = self.get_cropped_map_image()
+    def get_route_overlay(self, circle_radius, line_width, level=0):
+        # 'L' mask of every dimmed waypoint and leg, drawn per symbol size and map level and shared by the boards
+        # that follow with the same
+        key = (circle_radius, line_width, level)
+        if key in self.overlays:
+            # Moved to the end, after those used less recently
+            self.overlays[key] = self.overlays.pop(key)
+        else:
+            if len(self.overlays) >= max_cached_overlays:
+                del self.overlays[next(iter(self.overlays))]
+            box = self.get_route_overlay_box(circle_radius, line_width, level)
+            self.overlays[key] = (self.draw_route_overlay(circle_radius, line_width, level, box), box[0:2])
+        return self.overlays[key]
+
+    def get_route_overlay_box(self, circle_radius, line_width, level=0):
+        # pixel box at the given map level that every waypoint and leg is drawn within
+        scale = 1 / 2 ** level
+        padding = math.ceil(circle_radius + line_width)
+        return (
+            math.floor(self.min_x * scale) - padding,
+            math.floor(self.min_y * scale) - padding,
+            math.ceil(self.max_x * scale) + padding + 1,
+            math.ceil(self.max_y * scale) + padding + 1
+        )
 
-        draw = ImageDraw.Draw(img, "RGBA")
+    # box is a pixel box at the given map level
+    def draw_route_overlay(self, circle_radius, line_width, level, box):
+        scale = 1 / 2 ** level
+        overlay = Image.new('L', (box[2] - box[0], box[3] - box[1]))
+        draw = ImageDraw.Draw(overlay)
+        # Only the waypoints whose symbol or leg can reach into box, so a board's cost follows what it shows
+        # rather than the length of the route
+        for i in self.get_wps_within(box, level, circle_radius + line_width):
+            self.draw_for_wp_index(i, draw, circle_radius, line_width, False, box[0:2], scale)
+            self.draw_route_for_wp_from_prev(overlay, i, draw, circle_radius, line_width, False, box[0:2], scale)
+        return overlay
+
+    # overlay keys used by more than one board, levels being each board's map level
+    def get_shared_overlay_keys(self, levels):
+        counts = {}
+        for (index, level) in enumerate(levels):
+            key = self.get_symbol_size(index, level) + (level,)
+            counts[key] = counts.get(key, 0) + 1
+        return set(filter(lambda key: counts[key] > 1, counts.keys()))
+
+    def get_board_overlay_keys(self):
+        if self.shared_overlay_keys is None:
+            levels = list(map(self.get_board_level, range(len(self.waypoints))))
+            self.shared_overlay_keys = self.get_shared_overlay_keys(levels)
+        return self.shared_overlay_keys
+
+    # indexes of the waypoints whose position or leg in comes within padding of box, both in pixels of the given map level
+    def get_wps_within(self, box, level=0, padding=0):
+        factor = 2 ** level
+        return self.leg_index.query(tuple(map(lambda i: i * factor, box)), math.ceil((padding + 1) * factor))
+
+    def get_symbol_size(self, index, level=0):
+        # Symbols are sized for the board at map resolution, then shrunk along with the map level
+        scale = 1 / 2 ** level
         (board_height, board_width) = self.kneeboard_width_for_wp_index(index)
-        circle_radius = min(math.floor(board_width * waypoint_circle_radius_ratio), waypoint_circle_max_rad)
+        circle_radius = min(math.floor(board_width * waypoint_circle_radius_ratio), waypoint_circle_max_rad) * scale
         line_width = min(math.floor(board_width * waypoint_circle_width_ratio), waypoint_circle_max_width)
-        for i, wp in enumerate(self.waypoints):
-            is_current = i == index
-            is_previous = i == index - 1
-            self.draw_for_wp_index(i, draw, circle_radius, line_width, is_previous or is_current)
+        line_width = max(round(line_width * scale), 1)
+        return circle_radius, line_width
+
+    # region is a pixel box at the given map level to render, or None for the whole cropped map,
+    # symbol_size and cache_overlays default to the board's own and the route's setting
+    def create_board_for_wp(self, index, region=None, level=0, symbol_size=None, cache_overlays=None):
+        if region is None:
+            img = self.get_cropped_map_image()
+            region = (0, 0) + img.size
+        else:
+            img = self.get_map_region(region, level)
+        origin = region[0:2]
+
+        scale = 1 / 2 ** level
+        (circle_radius, line_width) = symbol_size or self.get_symbol_size(index, level)
+        if cache_overlays is None:
+            cache_overlays = self.cache_overlays
+
+        # Only an overlay other boards will use again is worth drawing for the whole route
+        if cache_overlays and (circle_radius, line_width, level) in self.get_board_overlay_keys():
+            (overlay, overlay_origin) = self.get_route_overlay(circle_radius, line_width, level)
+            overlay = overlay.crop((
+                region[0] - overlay_origin[0],
+                region[1] - overlay_origin[1],
+                region[2] - overlay_origin[0],
+                region[3] - overlay_origin[1]
+            ))
+        else:
+            overlay = self.draw_route_overlay(circle_radius, line_width, level, region)
+        img.paste((0, 0, 0), mask=overlay)
 
-            self.draw_route_for_wp_from_prev(img, i,  draw, circle_radius, line_width, is_current)
+        focus = Image.new('L', img.size)
+        draw = ImageDraw.Draw(focus)
+        if index > 0:
+            self.draw_for_wp_index(index - 1, draw, circle_radius, line_width, True, origin, scale)
+        self.draw_for_wp_index(index, draw, circle_radius, line_width, True, origin, scale)
+        self.draw_route_for_wp_from_prev(focus, index, draw, circle_radius, line_width, True, origin, scale)
+        img.paste((0, 0, 0), mask=focus)
         return img
 
-    def save_boards(self):
-        for i, wp in enumerate(self.waypoints):
-            board = self.create_board_for_wp(i)
-            cropped_board = self.crop_board_for_wp(i, board)
-            annotated_board = self.add_doghouse_for_wp(i, cropped_board)
-            annotated_board = annotated_board.resize((1600, 2400), resample=PIL.Image.BILINEAR)
-            board_name = "./%s/%s-wp%s.jpg" % (self.name, self.map.name, i+1)
-            annotated_board.save(board_name)
-            print("%s/%s  %s Board Complete" % (i+1, len(self.waypoints), board_name))
+    def get_board_name(self, index):
+        return "./%s/%s-wp%s.%s" % (self.name, self.map.name, index+1, self.board_format)
+
+    def get_overview_name(self):
+        return "./%s/%s-Overview.%s" % (self.name, self.map.name, self.board_format)
+
+    def get_overview_tiles_folder(self):
+        return "./%s/%s-Overview-tiles" % (self.name, self.map.name)
 
-        full_board = self.create_board_for_wp(i)
-        full_board.save("./%s/%s-Overview.jpg" % (self.name, self.map.name))
+    def save_image(self, img, filename):
+        options = {}
+        if self.board_quality is not None and self.board_format in ("jpg", "webp"):
+            options["quality"] = self.board_quality
+        img.save(filename, board_formats[self.board_format], **options)
+
+    def get_wp_key(self, index):
+        # everything about a waypoint that changes how its symbol and the leg into it are drawn
+        wp = self.waypoints[index]
+        key = [index, wp.x_pixel, wp.y_pixel, "IP" in wp.tags, "TGT" in wp.tags, wp.bearing_from_last]
+        if index > 0:
+            prev = self.waypoints[index - 1]
+            key += [prev.x_pixel, prev.y_pixel]
+        return key
+
+    def get_common_key(self):
+        return [
+            self.map.name,
+            get_map_stamp(self.map.name),
+            get_source_stamp(self.map.name),
+            self.map.get_raster().tiles is not None,
+            self.map.get_raster().draft_level,
+            self.cache_overlays,
+            get_render_settings(),
+            self.board_format,
+            self.board_quality
+        ] + ([] if self.board_resample is None else [self.board_resample])
+
+    def get_board_key(self, index):
+        # Hash of everything that can change board index's pixels: the map, the settings, the doghouse, the focused
+        # leg's times and every waypoint whose symbol or leg reaches into the board's region
+        level = self.get_board_level(index)
+        region = self.get_board_region(index, level)
+        box = tuple(map(lambda i: i * 2 ** level, region))
+        (x_max, y_max) = self.get_cropped_map_size()
+        visible = (min(region[2], x_max // 2 ** level), min(region[3], y_max // 2 ** level))
+        key = [self.get_common_key(), index, level, region, visible, self.get_doghouse_lines(index)]
+        for i in self.leg_index.query(box, waypoint_circle_max_rad + waypoint_circle_max_width):
+            key.append(self.get_wp_key(i))
+        key.append(list(map(lambda wp: wp.time, self.waypoints[max(index - 1, 0):index + 1])))
+        return get_key_hash(key)
+
+    def get_overview_key(self):
+        key = [self.get_common_key(), "overview", self.get_overview_level(), self.get_cropped_map_size()]
+        if self.overview_mode != "full":
+            key += [self.overview_mode, self.overview_size, self.get_overview_box(), self.overview_level]
+        key += list(map(self.get_wp_key, range(len(self.waypoints))))
+        key.append(list(map(lambda wp: wp.time, self.waypoints[-2:])))
+        return get_key_hash(key)
+
+    def save_board(self, index):
+        return self.finish_board(index, self.render_board(index))
+
+    def render_board(self, index):
+        # Long legs are drawn on a reduced map level rather than at full resolution and shrunk afterwards
+        level = self.get_board_level(index)
+        region = self.get_board_region(index, level)
+        with self.profiler.stage("draw", index):
+            board = self.create_board_for_wp(index, region, level)
+        if self.board_resample is not None:
+            return self.transform_board_for_wp(index, board, region[0:2], level)
+        with self.profiler.stage("crop", index):
+            return self.crop_board_for_wp(index, board, region[0:2], level)
+
+    # resizes, annotates and saves a board from render_board, safe to run alongside render_board for other boards
+    def finish_board(self, index, cropped_board):
+        resized_board = cropped_board
+        if self.board_resample is None:
+            with self.profiler.stage("resize", index):
+                resized_board = cropped_board.resize(board_output_size, resample=PIL.Image.BILINEAR)
+        with self.profiler.stage("doghouse", index):
+            annotated_board = self.add_doghouse_for_wp(index, resized_board)
+        board_name = self.get_board_name(index)
+        with self.profiler.stage("encode", index):
+            self.save_image(annotated_board, board_name)
+        return board_name
+
+    def save_boards_pipelined(self, encode_threads, indexes):
+        # Each board is resized and encoded on a thread while the next is drawn, Pillow lets go of the GIL for
+        # most of both. At most 2 boards per thread wait to be finished, so memory stays bounded
+        pending = []
+        with ThreadPoolExecutor(encode_threads) as executor:
+            for index in indexes:
+                if len(pending) >= encode_threads * 2:
+                    yield pending.pop(0).result()
+                pending.append(executor.submit(self.finish_board, index, self.render_board(index)))
+            for future in pending:
+                yield future.result()
+
+    def save_boards_in_parallel(self, jobs, indexes):
+        # Without tiles the decoded map is written out once as raw pixels that every worker maps
+        # read only, so it is neither pickled to nor decoded again by each of them
+        with self.profiler.stage("map share"):
+            self.map.get_raster().share()
+        # dict - number - number
+        # worker process id, its peak RSS in MB
+        peaks = {}
+        with multiprocessing.Pool(jobs, init_board_worker, (self,)) as pool:
+            # imap hands results back in waypoint order whichever worker finishes first
+            for (board_name, records, (pid, peak_mb)) in pool.imap(save_board_in_worker, indexes):
+                self.profiler.add_records(records)
+                peaks[pid] = peak_mb
+                yield board_name
+        add_worker_pool_peaks(peaks)
+
+    # Boards whose key matches the one in the output folder's manifest are left as they are, unless forced.
+    # Every board, then the overview, is added to bundle as it is finished when one is given, see bundle.py
+    def save_boards(self, jobs=1, force=False, encode_threads=1, bundle=None):
+        manifest_name = "./%s/manifest.json" % self.name
+        manifest = {} if force else read_board_manifest(manifest_name)
+        board_names = list(map(self.get_board_name, range(len(self.waypoints)))) + [self.get_overview_name()]
+        with self.profiler.stage("board keys"):
+            keys = list(map(self.get_board_key, range(len(self.waypoints)))) + [self.get_overview_key()]
+        stale = []
+        for (board_name, key) in zip(board_names, keys):
+            if manifest.get(os.path.basename(board_name)) != key or not os.path.exists(board_name):
+                manifest.pop(os.path.basename(board_name), None)
+                stale.append(board_name)
+        # Stale entries are dropped before rendering, so a run that fails part way never vouches for old boards
+        write_board_manifest(manifest_name, manifest)
+
+        indexes = [i for i in range(len(self.waypoints)) if board_names[i] in stale]
+        for i in range(len(self.waypoints)):
+            if i not in indexes:
+                print("%s/%s  %s Board Unchanged" % (i+1, len(self.waypoints), board_names[i]))
+        if jobs > 1 and len(indexes) > 0:
+            saved = self.save_boards_in_parallel(jobs, indexes)
+        elif encode_threads > 0:
+            saved = self.save_boards_pipelined(encode_threads, indexes)
+        else:
+            saved = map(self.save_board, indexes)
+        saved = iter(saved)
+        for i in range(len(self.waypoints)):
+            if i in indexes:
+                board_name = next(saved)
+                print("%s/%s  %s Board Complete" % (i+1, len(self.waypoints), board_name))
+                manifest[os.path.basename(board_name)] = keys[i]
+            if bundle is not None:
+                with self.profiler.stage("bundle", i):
+                    bundle.add_board(board_names[i])
+
+        tiles_index = "%s/tiles.json" % self.get_overview_tiles_folder()
+        if board_names[-1] in stale or (self.overview_mode == "tiled" and not os.path.exists(tiles_index)):
+            with self.profiler.stage("overview"):
+                self.save_image(self.render_overview(), board_names[-1])
+            if self.overview_mode == "tiled":
+                with self.profiler.stage("overview tiles"):
+                    self.save_overview_tiles()
+            else:
+                # Tiles left by an earlier tiled run no longer match the overview
+                shutil.rmtree(self.get_overview_tiles_folder(), ignore_errors=True)
+        manifest[os.path.basename(board_names[-1])] = keys[-1]
+        write_board_manifest(manifest_name, manifest)
+        if bundle is not None:
+            with self.profiler.stage("bundle"):
+                bundle.add_board(board_names[-1])
+        return board_names
+
+    def render_overview(self):
+        level = self.get_overview_level()
+        region = self.get_overview_region(level)
+        index = len(self.waypoints) - 1
+        if self.overview_mode == "full":
+            return self.create_board_for_wp(index, region, level)
+
+        (width, height) = (region[2] - region[0], region[3] - region[1])
+        scale = min(self.overview_size / max(width, height), 1)
+        overview = self.create_board_for_wp(index, region, level, self.get_overview_symbol_size(index, level, scale))
+        if scale < 1:
+            overview = overview.resize(
+                (max(round(width * scale), 1), max(round(height * scale), 1)),
+                resample=PIL.Image.BILINEAR
+            )
+        return overview
+
+    def save_overview_tiles(self):
+        # The overview's region at full detail as tiles, laid out as map_tiles does with each level halving the
+        # resolution of the one before. Every tile is drawn on its own, so only one is held at a time
+        folder = self.get_overview_tiles_folder()
+        shutil.rmtree(folder, ignore_errors=True)
+        first_level = max(self.overview_level, self.map.get_raster().draft_level)
+        index = len(self.waypoints) - 1
+        sizes = []
+        while len(sizes) == 0 or max(sizes[-1]) > tile_size:
+            level = first_level + len(sizes)
+            region = self.get_overview_region(level)
+            (width, height) = (region[2] - region[0], region[3] - region[1])
+            os.makedirs("%s/%s" % (folder, len(sizes)))
+            for tile_y in range(math.ceil(height / tile_size)):
+                for tile_x in range(math.ceil(width / tile_size)):
+                    tile_region = (
+                        region[0] + tile_x * tile_size,
+                        region[1] + tile_y * tile_size,
+                        min(region[0] + (tile_x + 1) * tile_size, region[2]),
+                        min(region[1] + (tile_y + 1) * tile_size, region[3])
+                    )
+                    tile = self.create_board_for_wp(index, tile_region, level, cache_overlays=False)
+                    self.save_image(tile, "%s/%s/%s_%s.%s" % (folder, len(sizes), tile_x, tile_y, self.board_format))
+            sizes.append([width, height])
+
+        # Written last so a half built pyramid is never mistaken for a finished one
+        with open("%s/tiles.json" % folder, "w") as f:
+            json.dump({
+                "tile_size": tile_size,
+                "sizes": sizes,
+                "format": self.board_format,
+                "map_level": first_level,
+                "origin": list(self.get_overview_region(first_level)[0:2])
+            }, f)
 
     def debug_doghouse(self):
-        for index, wp in enumerate(self.waypoints):
-
-            heading = "N/A"
-            if index > 0:
-                prev = self.waypoints[index - 1]
-                heading = "%s°" % ((wp.bearing_from(prev) - self.map.mag_var) % 360)
-            next_heading = "N/A"
-
-            if index < len(self.waypoints) - 1:
-                next_wp = self.waypoints[index + 1]
-                next_heading = "%s°" % ((next_wp.bearing_from(wp) - self.map.mag_var) % 360)
-
-            distance = "N/A"
-            if wp.distance_from_last is not None:
-                distance = "%snm" % round(wp.distance_from_last, 1)
-
-            time = "N/A"
-            if wp.time is not None:
-                hours = ("%s" % wp.time[0]).zfill(2)
-                minutes = ("%s" % wp.time[1]).zfill(2)
-                seconds = ("%s" % wp.time[2]).zfill(2)
-                time = f"{hours}:{minutes}:{seconds}"
-
-            speed = "N/A"
-            if wp.speed is not None:
-                speed = "%skts" % wp.speed
-
-            min_alt = "N/A"
-            if wp.min_alt is not None:
-                min_alt = f"{wp.min_alt:,}ft"
-
-            lines = [
-                ("WP:", wp.name),
-                ("MC:", heading),
-                ("DIST:", distance),
-                ("ETA:", time),
-                ("ESA:", min_alt),
-                ("TAS:", speed),
-                ("NMC:", next_heading)
-            ]
-            print(lines)
+        for index in range(len(self.waypoints)):
+            print(self.get_doghouse_lines(index))
         print(("Magvar: ", self.map.mag_var))
 
     def write_flight_notes(self):
@@ -473,11 +1010,196 @@ class Route:
         return output
 
 
+def init_board_worker(route):
+    global worker_route
+    worker_route = route
+    # A forked worker starts with a copy of what the parent recorded, and should only hand back its own stages
+    worker_route.profiler.take_records()
+
+
+def save_board_in_worker(index):
+    board_name = worker_route.save_board(index)
+    # The worker's peak so far, which only ever grows, so its last board's is the worker's own
+    return board_name, worker_route.profiler.take_records(), (os.getpid(), get_peak_rss_mb())
+
+
+# distances is every leg's distance as get_leg_geometry gives them, worked out here when not already known
+def get_timed_distances(waypoints, distances=None):
+    # leg distances up to the target, None for the first waypoint
+    [target_wp] = [x for x in waypoints if "TGT" in x.tags]
+    if distances is None:
+        (_, distances) = get_leg_geometry(waypoints[0:target_wp.index + 1])
+    return [None] + distances[0:target_wp.index]
+
+
+def read_route_waypoints(route_name):
+    with open("./routes/%s.csv" % route_name, newline='') as csv_file:
+        return parse_route_waypoints(csv_file)
+
+
+# lines of a route CSV, header row included
+def parse_route_waypoints(lines):
+    waypoints = []
+    reader = csv.reader(lines, delimiter=',', quotechar='|')
+    for i, record in enumerate(reader):
+        if i > 0:
+            waypoints.append(WayPoint(record, i-1))
+    return waypoints
+
+
+def get_render_settings():
+    # Drawing constants that change how boards look, part of every board key
+    return [
+        aspect_ratio,
+        margin_ratio,
+        waypoint_circle_radius_ratio,
+        waypoint_circle_width_ratio,
+        waypoint_circle_max_rad,
+        waypoint_circle_max_width,
+        board_output_size,
+        minute_label_font_size,
+        minute_label_box_size
+    ]
+
+
+def get_key_hash(key):
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+# dict - string - string
+# board file name, key it was rendered from
+def read_board_manifest(filename):
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f)["boards"]
+    except (ValueError, KeyError):
+        return {}
+
+
+def write_board_manifest(filename, boards):
+    with open(filename, "w") as f:
+        json.dump({"boards": boards}, f, indent=2, sort_keys=True)
+
+
+@lru_cache(maxsize=256)
+def get_minute_label_text(text, font_size, box_size):
+    label = Image.new('L', (box_size, box_size))
+    d = ImageDraw.Draw(label)
+    d.text((0, 0), text, fill=255, font_size=font_size, align="left")
+    return label
+
+
+# Labels are shared between every tick, leg and board that needs them, so callers must not modify them
+@lru_cache(maxsize=256)
+def get_minute_label(text, font_size, box_size, angle):
+    return get_minute_label_text(text, font_size, box_size).rotate(angle, expand=1)
+
+
 def get_font_size(img):
     line_height_ratio = 0.02
     return math.floor(line_height_ratio * img.height)
 
 
+class TestRoute(unittest.TestCase):
+    def test_region_crop_samples_as_a_full_map_rotate(self):
+        img = Image.effect_noise((1600, 1600), 80)
+        pixels = np.asarray(img)
+        route = Route.__new__(Route)
+        route.profiler = Profiler()
+        for (x, y) in [(300, 370), (400, 150), (-380, 120), (-90, -450)]:
+            route.waypoints = [WayPoint(["wp1", "0", "0", "0", "0", "0", "0"], 0),
+                               WayPoint(["wp2", "0", "0", "0", "0", "0", "0"], 1)]
+            (route.waypoints[0].x_pixel, route.waypoints[0].y_pixel) = (800 - x, 800 - y)
+            (route.waypoints[1].x_pixel, route.waypoints[1].y_pixel) = (800 + x, 800 + y)
+            region = route.get_board_region(1)
+            board = np.asarray(route.crop_board_for_wp(1, img.crop(region), region[:2]))
+            full_board = np.asarray(route.crop_board_for_wp(1, img))
+            self.assertEqual(board.shape, full_board.shape)
+
+            # Exact nearest sampling, as Image.rotate would be without its fixed point arithmetic
+            (x_centre, y_centre, bearing) = route.get_board_rotation(1)
+            (board_width, board_height) = route.kneeboard_width_for_wp_index(1)
+            (cos, sin) = (math.cos(math.radians(-bearing)), math.sin(math.radians(-bearing)))
+            (xs, ys) = np.meshgrid(
+                np.arange(board.shape[1]) + round(x_centre - board_width / 2) + 0.5 - x_centre,
+                np.arange(board.shape[0]) + round(y_centre - board_height / 2) + 0.5 - y_centre
+            )
+            (xs, ys) = (cos * xs + sin * ys + x_centre, -sin * xs + cos * ys + y_centre)
+            expected = pixels[np.floor(ys).astype(int), np.floor(xs).astype(int)]
+            clear = np.minimum(abs(xs - np.round(xs)), abs(ys - np.round(ys))) > 1 / 32
+
+            self.assertGreater(clear.mean(), 0.8)
+            self.assertTrue((board[clear] == expected[clear]).all())
+            self.assertTrue((full_board[clear] == expected[clear]).all())
+
+
+class TestRouteRendering(unittest.TestCase):
+    # Renders in a synthetic theatre of 1000 pixels per degree from N45 E37, as ./data and ./routes are read
+    # from the working folder
+    start_folder = None
+    folder = None
+
+    def setUp(self):
+        self.start_folder = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        os.makedirs("./data/synthetic")
+        os.makedirs("./routes")
+        Image.effect_noise((3000, 2500), 64).convert("RGB").save("./data/synthetic/map.jpg")
+        with open("./data/synthetic/map.csv", "w") as f:
+            f.write("lat, long, x, y\n")
+            for lat in range(41, 46):
+                for long in range(37, 41):
+                    f.write("%s, %s, %s, %s\n" % (lat, long, (long - 37) * 1000, (45 - lat) * 1000))
+        # Two short legs sharing the first waypoint's board size, then longer legs each with their own
+        points = [(44, 0, 38, 0, ""), (44, 0, 38, 18, ""), (43, 42, 38, 18, ""), (43, 42, 39, 30, ""),
+                  (43, 0, 39, 30, "IP"), (43, 0, 38, 30, "TGT")]
+        with open("./routes/synthetic.csv", "w") as f:
+            f.write("name, latd, latm, lats, longd, longm, longs, tags\n")
+            for (i, (lat_d, lat_m, long_d, long_m, tag)) in enumerate(points):
+                f.write("WP%s, %s, %s, 0, %s, %s, 0, %s\n" % (i + 1, lat_d, lat_m, long_d, long_m, tag))
+
+    def tearDown(self):
+        os.chdir(self.start_folder)
+        release_map_raster("synthetic")
+        shutil.rmtree(self.folder)
+
+    def test_route_overlay_is_drawn_once_for_the_boards_sharing_it(self):
+        route = Route("synthetic")
+        boxes = []
+        draw_route_overlay = route.draw_route_overlay
+
+        def count_draws(circle_radius, line_width, level, box):
+            boxes.append(box)
+            return draw_route_overlay(circle_radius, line_width, level, box)
+        route.draw_route_overlay = count_draws
+        for index in range(len(route.waypoints)):
+            route.render_board(index)
+
+        keys = list(map(lambda i: route.get_symbol_size(i) + (0,), range(len(route.waypoints))))
+        self.assertEqual(route.get_board_overlay_keys(), set(filter(lambda key: keys.count(key) > 1, keys)))
+        self.assertIn(keys[0], route.get_board_overlay_keys())
+        # A route overlay the first time a shared size is drawn, otherwise only the board's own region
+        expected = []
+        for (index, key) in enumerate(keys):
+            if keys.count(key) == 1:
+                expected.append(route.get_board_region(index))
+            elif keys.index(key) == index:
+                expected.append(route.get_route_overlay_box(*key))
+        self.assertEqual(boxes, expected)
+
+    def test_workers_only_report_their_own_stages(self):
+        route = Route("synthetic", profiler=Profiler(True))
+        os.mkdir("./synthetic")
+        route.save_boards(jobs=2)
+        totals = route.profiler.get_report()["totals"]
+        for stage in ("csv parse", "map selection", "board keys", "map share", "overview"):
+            self.assertEqual(totals[stage]["count"], 1)
+        self.assertEqual(totals["draw"]["count"], len(route.waypoints))
+
+
 if __name__ == "__main__":
     # Route("example", (0, 0, 0), (0, 30, 0)).save_boards()
     print(Route("01-05-2025-training", (0, 0, 0), (0, 30, 0)).save_boards())
@@ -0,0 +1,194 @@
+import argparse
+import io
+import json
+import os
+import re
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from main import render_route
+from map_file import get_map_index, get_map_raster
+from profiler import Profiler
+from route import parse_route_waypoints
+from tot_planner import parse_time
+
+# Route names become output folder names, so nothing that could climb out of the working folder
+route_name_pattern = re.compile(r"^[A-Za-z0-9_\-]+$")
+board_name_pattern = re.compile(r"^[A-Za-z0-9_\-]+\.(jpg|png|webp|txt)$")
+# largest route CSV accepted, in bytes
+max_route_size = 1024 * 1024
+
+
+class RenderQueue:
+    # Admits at most workers + queue_size requests at a time, workers of them render while the rest wait
+    workers = None
+    queue_size = None
+    admitted = 0
+    slots = None
+    lock = None
+    # dict - string - Lock
+    # one per route name, so two requests never write the same output folder at once
+    route_locks = None
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.slots = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        self.route_locks = {}
+
+    def enter(self):
+        with self.lock:
+            if self.admitted >= self.workers + self.queue_size:
+                return False
+            self.admitted += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.admitted -= 1
+
+    def get_route_lock(self, route_name):
+        with self.lock:
+            return self.route_locks.setdefault(route_name, threading.Lock())
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "rendering": min(self.admitted, self.workers),
+                "waiting": max(self.admitted - self.workers, 0)
+            }
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    # RenderQueue, set by serve
+    render_queue = None
+
+    def do_GET(self):
+        path = urlparse(self.path).path.strip("/").split("/")
+        if path == ["status"]:
+            self.send_json(200, self.render_queue.get_status())
+        elif len(path) == 3 and path[0] == "routes" and route_name_pattern.match(path[1]) and board_name_pattern.match(path[2]):
+            filename = "./%s/%s" % (path[1], path[2])
+            if not os.path.isfile(filename):
+                self.send_json(404, {"error": "%s not found" % self.path})
+                return
+            with open(filename, "rb") as f:
+                self.send_body(200, get_content_type(filename), f.read())
+        else:
+            self.send_json(404, {"error": "%s not found" % self.path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        path = url.path.strip("/").split("/")
+        if len(path) != 2 or path[0] != "routes" or not route_name_pattern.match(path[1]):
+            self.send_json(404, {"error": "post route CSVs to /routes/<route name>"})
+            return
+        route_name = path[1]
+        length = int(self.headers.get("Content-Length", 0))
+        if length > max_route_size:
+            self.send_json(413, {"error": "route CSV is over %s bytes" % max_route_size})
+            return
+        body = self.rfile.read(length).decode("utf-8-sig")
+
+        try:
+            query = parse_qs(url.query)
+            start_time = parse_time(query["start"][0]) if "start" in query else (0, 0, 0)
+            time_on_target = parse_time(query["tot"][0]) if "tot" in query else None
+            board_format = query["format"][0] if "format" in query else "jpg"
+            board_quality = int(query["quality"][0]) if "quality" in query else None
+            waypoints = parse_route_waypoints(io.StringIO(body, newline=""))
+        except Exception as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        if not self.render_queue.enter():
+            self.send_json(503, {"error": "render queue is full"}, {"Retry-After": "5"})
+            return
+        try:
+            with self.render_queue.slots, self.render_queue.get_route_lock(route_name):
+                (notes, board_names) = render_route(
+                    route_name,
+                    start_time,
+                    time_on_target,
+                    waypoints=waypoints,
+                    board_format=board_format,
+                    board_quality=board_quality
+                )
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(400, {"error": str(e)})
+            return
+        finally:
+            self.render_queue.leave()
+
+        self.send_json(200, {
+            "route": route_name,
+            "notes": notes,
+            "boards": list(map(lambda i: "/routes/%s/%s" % (route_name, os.path.basename(i)), board_names))
+        })
+
+    def send_json(self, status, body, headers=None):
+        self.send_body(status, "application/json", json.dumps(body, indent=2).encode("utf-8"), headers)
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def get_content_type(filename):
+    return {
+        ".jpg": "image/jpeg",
+        ".png": "image/png",
+        ".webp": "image/webp",
+        ".txt": "text/plain; charset=utf-8"
+    }[os.path.splitext(filename)[1]]
+
+
+def load_theatres(decode):
+    # Opens every theatre's map up front and keeps it for the life of the server
+    for name in get_map_index().keys():
+        raster = get_map_raster(name)
+        if decode:
+            print("Decoding %s" % name)
+            raster.load(Profiler())
+
+
+def serve(host, port, workers, queue_size, decode):
+    load_theatres(decode)
+    RenderRequestHandler.render_queue = RenderQueue(workers, queue_size)
+    server = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    print("Serving kneeboards on http://%s:%s" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve dead reckoning kneeboards over HTTP with the maps kept loaded")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="routes rendered at the same time")
+    parser.add_argument("--queue", type=int, default=8, help="routes waiting to render before requests are turned away")
+    parser.add_argument(
+        "--preload",
+        action="store_true",
+        help="decode every map at start up rather than on its first route"
+    )
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.queue, args.preload)
+
+
+if __name__ == '__main__':
+    main()
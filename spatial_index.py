@@ -0,0 +1,66 @@
+import math
+import unittest
+
+# map pixels along each side of a grid cell
+default_cell_size = 2048
+
+
+class SegmentGrid:
+    # Buckets line segments by the grid cells their bounding boxes reach into, so the few near a box are found
+    # without checking every one of them
+    cell_size = None
+    # list - (number, number, number, number)
+    # bounding box of each segment
+    boxes = None
+    # dict - (number, number) - list
+    # cell, indexes of the segments reaching into it
+    cells = None
+
+    # segments are ((x, y), (x, y)) pairs of ends, a point being a segment with both ends the same
+    def __init__(self, segments, cell_size=default_cell_size):
+        self.cell_size = cell_size
+        self.boxes = list(map(lambda i: (
+            min(i[0][0], i[1][0]),
+            min(i[0][1], i[1][1]),
+            max(i[0][0], i[1][0]),
+            max(i[0][1], i[1][1])
+        ), segments))
+        self.cells = {}
+        for (index, box) in enumerate(self.boxes):
+            for cell in self.get_cells(box):
+                self.cells.setdefault(cell, []).append(index)
+
+    def get_cells(self, box):
+        for cell_y in range(math.floor(box[1] / self.cell_size), math.floor(box[3] / self.cell_size) + 1):
+            for cell_x in range(math.floor(box[0] / self.cell_size), math.floor(box[2] / self.cell_size) + 1):
+                yield cell_x, cell_y
+
+    # indexes in order of the segments whose bounding boxes overlap box, once grown by padding on every side
+    def query(self, box, padding=0):
+        (x_min, y_min, x_max, y_max) = (box[0] - padding, box[1] - padding, box[2] + padding, box[3] + padding)
+        found = set()
+        for cell in self.get_cells((x_min, y_min, x_max, y_max)):
+            for index in self.cells.get(cell, []):
+                (seg_x_min, seg_y_min, seg_x_max, seg_y_max) = self.boxes[index]
+                if seg_x_min < x_max and x_min < seg_x_max and seg_y_min < y_max and y_min < seg_y_max:
+                    found.add(index)
+        return sorted(found)
+
+
+class TestSegmentGrid(unittest.TestCase):
+    def test_query_matches_checking_every_segment(self):
+        segments = [((0, 0), (0, 0))]
+        for i in range(1, 200):
+            segments.append((segments[-1][1], ((i * 7919) % 20000 - 5000, (i * 104729) % 15000)))
+        grid = SegmentGrid(segments, 1000)
+        for box in [(-6000, -100, 16000, 16000), (300, 4000, 2500, 4100), (-500, -500, -100, -100), (0, 0, 1, 1)]:
+            expected = [
+                i for (i, (a, b)) in enumerate(segments)
+                if min(a[0], b[0]) < box[2] + 50 and box[0] - 50 < max(a[0], b[0]) and
+                min(a[1], b[1]) < box[3] + 50 and box[1] - 50 < max(a[1], b[1])
+            ]
+            self.assertEqual(grid.query(box, 50), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
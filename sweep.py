@@ -0,0 +1,87 @@
+import argparse
+from functools import partial
+import itertools
+import math
+from route import get_timed_distances, read_route_waypoints
+from tot_planner import hours_to_time, parse_time, sweep_solved_speed_and_hold, sweep_speed_and_hold, time_to_hours
+
+
+def parse_time_range(text):
+    # hours:minutes:seconds, or first-last/step of them with a minute step by default
+    (times, _, step) = text.partition("/")
+    (first, _, last) = times.partition("-")
+    first = parse_time(first)
+    if last == "":
+        return [first]
+    last = time_to_hours(parse_time(last))
+    step = time_to_hours(parse_time(step)) if step != "" else 1 / 60
+    if step <= 0:
+        raise Exception("%s step must be above zero" % text)
+    return list(map(
+        lambda i: hours_to_time(time_to_hours(first) + i * step + 1e-9),
+        range(math.floor((last - time_to_hours(first)) / step + 1e-9) + 1)
+    ))
+
+
+def parse_speeds(text):
+    return list(map(lambda i: int(i.strip()), text.split(",")))
+
+
+def format_time(t):
+    return "%02d:%02d:%02d" % t
+
+
+def format_result(results, i):
+    if not results["feasible"][i]:
+        return "-"
+    return "%s %s" % (results["speed"][i], format_time(hours_to_time(results["hold"][i])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cruise speed and hold for each route over ranges of start times and ToTs")
+    parser.add_argument("routes", nargs="+", help="route names, as in ./routes")
+    parser.add_argument("--start", default="00:00:00", help="start time, or first-last/step range of them")
+    parser.add_argument("--tot", required=True, help="ToT, or first-last/step range of them")
+    parser.add_argument("--dash", default="500", help="comma separated dash speeds")
+    parser.add_argument("--min-cruise", default="300", help="comma separated minimum cruise speeds")
+    parser.add_argument("--max-cruise", type=int, default=560, help="fastest cruise speed in knots")
+    parser.add_argument(
+        "--speed-ladder",
+        action="store_true",
+        help="pick the cruise speed from the fixed 240 to 560kts options rather than solving for it exactly"
+    )
+    parser.add_argument("--feasible-only", action="store_true", help="only list timings every route can make")
+    args = parser.parse_args()
+
+    start_times = parse_time_range(args.start)
+    times_on_target = parse_time_range(args.tot)
+    dash_speeds = parse_speeds(args.dash)
+    min_cruise_speeds = parse_speeds(args.min_cruise)
+    sweep = partial(sweep_solved_speed_and_hold, max_cruise_speed=args.max_cruise)
+    if args.speed_ladder:
+        sweep = partial(sweep_speed_and_hold, max_cruise_speed=args.max_cruise)
+    results = list(map(
+        lambda i: sweep(
+            get_timed_distances(read_route_waypoints(i)),
+            start_times,
+            times_on_target,
+            dash_speeds,
+            min_cruise_speeds
+        ),
+        args.routes
+    ))
+
+    print("\t".join(["start", "ToT", "dash", "min cruise"] + args.routes))
+    for i in itertools.product(*map(lambda j: range(len(j)), (start_times, times_on_target, dash_speeds, min_cruise_speeds))):
+        if args.feasible_only and not all(map(lambda j: j["feasible"][i], results)):
+            continue
+        print("\t".join([
+            format_time(start_times[i[0]]),
+            format_time(times_on_target[i[1]]),
+            str(dash_speeds[i[2]]),
+            str(min_cruise_speeds[i[3]])
+        ] + list(map(lambda j: format_result(j, i), results))))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
 import math
+import numpy as np
+import unittest
+
+# cruise speeds the planner picks from, slowest first
+speed_options = [240, 300, 360, 420, 490, 560]
+# cruise speed flown when there is no ToT to make
+default_cruise_speed = 420
 
 
 # returns shape (Speed, hold_time_hrs) or None
-def find_speed_and_hold(distances, dash_speed, time_hrs, min_cruise_speed=360):
+def find_speed_and_hold(distances, dash_speed, time_hrs, min_cruise_speed=360, max_cruise_speed=560):
     if time_hrs is None:
-        return 420, 0
+        return default_cruise_speed, 0
     distances = list(map(lambda i:  0 if i is None else i, distances))
     cruise = distances[0:-1]
     dash_distance = distances[-1]
@@ -12,8 +19,7 @@ def find_speed_and_hold(distances, dash_speed, time_hrs, min_cruise_speed=360):
 
     dash_duration = (dash_distance/dash_speed)
     cruise_time = time_hrs-dash_duration
-    speed_options = [240, 300, 360, 420, 490, 560]
-    available_speeds = list(filter(lambda s: s >= min_cruise_speed, speed_options))
+    available_speeds = list(filter(lambda s: min_cruise_speed <= s <= max_cruise_speed, speed_options))
     speed_times = list(filter(
         lambda t: t < cruise_time,
         list(map(lambda s: cruise_distance/s, available_speeds))
@@ -23,7 +29,174 @@ def find_speed_and_hold(distances, dash_speed, time_hrs, min_cruise_speed=360):
     return math.floor(cruise_distance/best_time), hold
 
 
-def get_waypoint_times(distances, start_time, time_on_target, dash_speed=500, min_cruise_speed=300):
+# Same choice as find_speed_and_hold for every combination of the given start times, ToTs, dash speeds and
+# minimum cruise speeds at once, up to max_cruise_speed. Returns arrays shaped (starts, ToTs, dash speeds,
+# minimum cruise speeds) of "speed", 0 where no speed fits, "hold" in hours, NaN where no speed fits, and "feasible"
+def sweep_speed_and_hold(
+        distances, start_times, times_on_target, dash_speeds=(500,), min_cruise_speeds=(300,), max_cruise_speed=560
+):
+    distances = list(map(lambda i:  0 if i is None else i, distances))
+    cruise_distance = sum(distances[0:-1])
+    dash_distance = distances[-1]
+
+    starts = np.array(list(map(time_to_hours, start_times)), dtype=float)[:, None, None, None]
+    tots = np.array(list(map(time_to_hours, times_on_target)), dtype=float)[None, :, None, None]
+    dashes = np.array(dash_speeds, dtype=float)[None, None, :, None]
+    min_cruises = np.array(min_cruise_speeds, dtype=float)[None, None, None, :]
+    speeds = np.array(speed_options, dtype=float)
+
+    time_hrs = tots - starts
+    dash_duration = dash_distance / dashes
+    cruise_time = time_hrs - dash_duration
+    speed_times = cruise_distance / speeds
+    # axis 4 runs through speed_options, slowest first
+    usable = (speeds >= min_cruises[..., None]) & (speeds <= max_cruise_speed) & (speed_times < cruise_time[..., None])
+    feasible = usable.any(axis=4)
+    best_time = speed_times[usable.argmax(axis=4)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speed = np.floor(cruise_distance / best_time)
+    hold = time_hrs - best_time - dash_duration
+    return {
+        "speed": np.where(feasible, speed, 0).astype(int),
+        "hold": np.where(feasible, hold, np.nan),
+        "feasible": feasible
+    }
+
+
+class SpeedSolution:
+    # Result of solve_speed_and_hold, nothing but reason and required_speed is set unless feasible
+    feasible = False
+    # number - cruise speed in knots, before any leg's own limits
+    speed = None
+    # list - number
+    # speed flown on each leg, indexed like distances with None for the first waypoint and the dash leg's speed last
+    leg_speeds = None
+    # number - hours held before the first leg
+    hold = None
+    # string - why no speed makes the ToT
+    reason = None
+    # number - cruise speed the ToT would need, None when no speed could make it
+    required_speed = None
+
+
+def get_legs_time(legs, speed):
+    # legs are (distance, slowest, fastest), each flown at speed kept within its limits
+    return sum(map(lambda leg: leg[0] / min(max(speed, leg[1]), leg[2]), legs))
+
+
+# The slowest common cruise speed, in whole knots when whole_knots, that still makes the ToT, holding for whatever time
+# is left. leg_limits optionally gives each cruise leg its own (slowest, fastest), indexed like distances, which are
+# kept within the overall cruise limits. Works in O(n log n) of the legs
+def solve_speed_and_hold(
+        distances,
+        dash_speed,
+        time_hrs,
+        min_cruise_speed=300,
+        max_cruise_speed=560,
+        leg_limits=None,
+        whole_knots=True
+):
+    solution = SpeedSolution()
+    distances = list(map(lambda i:  0 if i is None else i, distances))
+    dash_distance = distances[-1]
+    legs = []
+    for i in range(1, len(distances) - 1):
+        (slowest, fastest) = (min_cruise_speed, max_cruise_speed)
+        if leg_limits is not None and leg_limits[i] is not None:
+            (slowest, fastest) = (max(leg_limits[i][0], slowest), min(leg_limits[i][1], fastest))
+        if slowest > fastest:
+            solution.reason = "Leg %s's speed limits are outside %s to %skts" % (i, min_cruise_speed, max_cruise_speed)
+            return solution
+        legs.append((distances[i], slowest, fastest))
+
+    if time_hrs is None:
+        # Kept within the cruise limits, as every leg's speed is
+        speed = min(max(default_cruise_speed, min_cruise_speed), max_cruise_speed)
+    else:
+        cruise_time = time_hrs - (dash_distance / dash_speed)
+        cruise_distance = sum(map(lambda leg: leg[0], legs))
+        if cruise_time > 0:
+            solution.required_speed = cruise_distance / cruise_time
+        if cruise_time <= 0 or get_legs_time(legs, math.inf) > cruise_time:
+            solution.reason = "ToT is too soon, the route needs %s" % (
+                "more time than the dash alone" if solution.required_speed is None
+                else "%skts cruise" % math.ceil(solution.required_speed)
+            )
+            return solution
+
+        if get_legs_time(legs, 0) <= cruise_time:
+            speed = min_cruise_speed
+        else:
+            # Time falls as speed rises, so the answer lies between the two neighbouring leg limits that straddle it
+            limits = sorted(set(map(lambda leg: leg[1], legs)) | set(map(lambda leg: leg[2], legs)))
+            (low, high) = (0, len(limits) - 1)
+            while high - low > 1:
+                middle = (low + high) // 2
+                if get_legs_time(legs, limits[middle]) > cruise_time:
+                    low = middle
+                else:
+                    high = middle
+            fixed_time = 0
+            free_distance = 0
+            for (distance, slowest, fastest) in legs:
+                if fastest <= limits[low]:
+                    fixed_time += distance / fastest
+                elif slowest >= limits[high]:
+                    fixed_time += distance / slowest
+                else:
+                    free_distance += distance
+            speed = free_distance / (cruise_time - fixed_time)
+            if whole_knots:
+                # Rounding up arrives early rather than late, the hold takes up the difference
+                speed = math.ceil(speed - 1e-9)
+        solution.hold = max(cruise_time - get_legs_time(legs, speed), 0)
+
+    solution.feasible = True
+    solution.speed = speed
+    solution.leg_speeds = [None] + list(map(lambda leg: min(max(speed, leg[1]), leg[2]), legs)) + [dash_speed]
+    if time_hrs is None:
+        solution.hold = 0
+    return solution
+
+
+# Same as solve_speed_and_hold without leg limits, for every combination as sweep_speed_and_hold
+def sweep_solved_speed_and_hold(
+        distances, start_times, times_on_target, dash_speeds=(500,), min_cruise_speeds=(300,), max_cruise_speed=560
+):
+    distances = list(map(lambda i:  0 if i is None else i, distances))
+    cruise_distance = sum(distances[1:-1])
+    dash_distance = distances[-1]
+
+    starts = np.array(list(map(time_to_hours, start_times)), dtype=float)[:, None, None, None]
+    tots = np.array(list(map(time_to_hours, times_on_target)), dtype=float)[None, :, None, None]
+    dashes = np.array(dash_speeds, dtype=float)[None, None, :, None]
+    min_cruises = np.array(min_cruise_speeds, dtype=float)[None, None, None, :]
+
+    time_hrs = tots - starts
+    cruise_time = time_hrs - dash_distance / dashes
+    with np.errstate(divide="ignore", invalid="ignore"):
+        required_speed = np.where(cruise_time > 0, cruise_distance / cruise_time, np.inf)
+    feasible = (required_speed <= max_cruise_speed) & (min_cruises <= max_cruise_speed)
+    speed = np.maximum(np.ceil(required_speed - 1e-9), min_cruises)
+    speed = np.where(required_speed <= min_cruises, min_cruises, speed)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hold = np.maximum(cruise_time - cruise_distance / speed, 0)
+    return {
+        "speed": np.where(feasible, speed, 0).astype(int),
+        "hold": np.where(feasible, hold, np.nan),
+        "feasible": feasible
+    }
+
+
+def get_waypoint_times(
+        distances,
+        start_time,
+        time_on_target,
+        dash_speed=500,
+        min_cruise_speed=300,
+        max_cruise_speed=560,
+        speed_ladder=False
+):
     print("Start: %s", start_time)
     print("TOT: %s", time_on_target)
 
@@ -33,12 +206,21 @@ def get_waypoint_times(distances, start_time, time_on_target, dash_speed=500, mi
                        ((time_on_target[1] - start_time[1])/60) +\
                        ((time_on_target[2] - start_time[2])/3600)
 
-    speed_attempt = find_speed_and_hold(distances, dash_speed, duration_hrs, min_cruise_speed)
-    if speed_attempt is None:
-        raise Exception("No valid speed for this route")
-    (speed, hold) = speed_attempt
+    if speed_ladder:
+        # Picked from speed_options, rather than solving for the exact speed
+        speed_attempt = find_speed_and_hold(distances, dash_speed, duration_hrs, min_cruise_speed, max_cruise_speed)
+        if speed_attempt is None:
+            raise Exception("No valid speed for this route")
+        (speed, hold) = speed_attempt
+        leg_speeds = [speed] * len(distances)
+    else:
+        solution = solve_speed_and_hold(distances, dash_speed, duration_hrs, min_cruise_speed, max_cruise_speed)
+        if not solution.feasible:
+            raise Exception(solution.reason)
+        (speed, hold, leg_speeds) = (solution.speed, solution.hold, solution.leg_speeds)
     output = []
-    total_time = hold
+    # Times are clock times, counted from the start time
+    total_time = time_to_hours(start_time) + hold
     for i, distance in enumerate(distances):
         if i == 0:
             output.append(hours_to_time(total_time))
@@ -46,7 +228,7 @@ def get_waypoint_times(distances, start_time, time_on_target, dash_speed=500, mi
             total_time += (distance / dash_speed)
             output.append(hours_to_time(total_time))
         elif distance is not None:
-            total_time += (distance/speed)
+            total_time += (distance/leg_speeds[i])
             output.append(hours_to_time(total_time))
         else:
             output.append(None)
@@ -67,6 +249,10 @@ def hours_to_time(t):
     return hours, minutes, seconds
 
 
+def time_to_hours(t):
+    return t[0] + (t[1] / 60) + (t[2] / 3600)
+
+
 def time_to_minutes(t):
     seconds = t[2]/60
     minutes = t[1]
@@ -74,5 +260,91 @@ def time_to_minutes(t):
     return seconds + minutes + hours
 
 
+class TestTotPlanner(unittest.TestCase):
+    def test_sweep_matches_find_speed_and_hold(self):
+        distances = [None, 61.7, 46.2, 40.2, 30.0]
+        start_times = [(0, 0, 0), (0, 10, 30)]
+        times_on_target = [(0, 30, 0), (0, 45, 0), (1, 0, 0), (1, 30, 0)]
+        dash_speeds = [450, 500]
+        min_cruise_speeds = [240, 360]
+        results = sweep_speed_and_hold(distances, start_times, times_on_target, dash_speeds, min_cruise_speeds)
+        for (a, start) in enumerate(start_times):
+            for (b, time_on_target) in enumerate(times_on_target):
+                for (c, dash_speed) in enumerate(dash_speeds):
+                    for (d, min_cruise_speed) in enumerate(min_cruise_speeds):
+                        time_hrs = time_to_hours(time_on_target) - time_to_hours(start)
+                        try:
+                            (speed, hold) = find_speed_and_hold(distances, dash_speed, time_hrs, min_cruise_speed)
+                        except IndexError:
+                            self.assertFalse(results["feasible"][a, b, c, d])
+                            continue
+                        self.assertTrue(results["feasible"][a, b, c, d])
+                        self.assertEqual(results["speed"][a, b, c, d], speed)
+                        self.assertAlmostEqual(results["hold"][a, b, c, d], hold)
+
+    def test_speed_ladder_keeps_to_max_cruise_speed(self):
+        distances = [None, 61.7, 46.2, 40.2, 30.0]
+        times_on_target = [(0, 20, 0), (0, 30, 0), (0, 45, 0)]
+        results = sweep_speed_and_hold(distances, [(0, 0, 0)], times_on_target, max_cruise_speed=420)
+        for (b, time_on_target) in enumerate(times_on_target):
+            time_hrs = time_to_hours(time_on_target)
+            try:
+                (speed, hold) = find_speed_and_hold(distances, 500, time_hrs, 300, 420)
+            except IndexError:
+                self.assertFalse(results["feasible"][0, b, 0, 0])
+                continue
+            self.assertLessEqual(speed, 420)
+            self.assertEqual(results["speed"][0, b, 0, 0], speed)
+        # 148.1nm of cruise in 26.4 minutes needs over 420kts
+        self.assertFalse(results["feasible"][0, 0, 0, 0])
+        self.assertTrue(results["feasible"][0, 2, 0, 0])
+
+    def test_solved_speed_makes_tot_exactly(self):
+        distances = [None, 61.7, 46.2, 40.2, 30.0]
+        solution = solve_speed_and_hold(distances, 500, 0.5, whole_knots=False)
+        self.assertTrue(solution.feasible)
+        self.assertAlmostEqual(solution.hold, 0)
+        self.assertAlmostEqual(sum(distances[1:-1]) / solution.speed + 30 / 500, 0.5)
+
+    def test_solved_speed_respects_leg_limits(self):
+        distances = [None, 50, 50, 10]
+        solution = solve_speed_and_hold(distances, 500, 0.3, leg_limits=[None, (300, 350), None, None])
+        self.assertTrue(solution.feasible)
+        self.assertEqual(solution.leg_speeds[1], 350)
+        self.assertGreater(solution.leg_speeds[2], 350)
+        self.assertAlmostEqual(50 / 350 + 50 / solution.leg_speeds[2] + 10 / 500 + solution.hold, 0.3)
+
+    def test_speed_without_tot_is_within_cruise_limits(self):
+        distances = [None, 50, 50, 10]
+        solution = solve_speed_and_hold(distances, 500, None, min_cruise_speed=450)
+        self.assertEqual(solution.speed, 450)
+        self.assertEqual(solution.leg_speeds, [None, 450, 450, 500])
+        solution = solve_speed_and_hold(distances, 500, None, max_cruise_speed=400)
+        self.assertEqual(solution.speed, 400)
+        self.assertEqual(solution.leg_speeds, [None, 400, 400, 500])
+
+    def test_unreachable_tot_is_reported(self):
+        solution = solve_speed_and_hold([None, 100, 100, 20], 500, 0.2)
+        self.assertFalse(solution.feasible)
+        self.assertEqual(solution.required_speed, 1250)
+        self.assertIsNotNone(solution.reason)
+
+    def test_solved_sweep_matches_solve_speed_and_hold(self):
+        distances = [None, 61.7, 46.2, 40.2, 30.0]
+        start_times = [(0, 0, 0), (0, 10, 30)]
+        times_on_target = [(0, 20, 0), (0, 30, 0), (1, 30, 0)]
+        results = sweep_solved_speed_and_hold(distances, start_times, times_on_target, [450, 500], [240, 360])
+        for (a, start) in enumerate(start_times):
+            for (b, time_on_target) in enumerate(times_on_target):
+                for (c, dash_speed) in enumerate([450, 500]):
+                    for (d, min_cruise_speed) in enumerate([240, 360]):
+                        time_hrs = time_to_hours(time_on_target) - time_to_hours(start)
+                        solution = solve_speed_and_hold(distances, dash_speed, time_hrs, min_cruise_speed)
+                        self.assertEqual(results["feasible"][a, b, c, d], solution.feasible)
+                        if solution.feasible:
+                            self.assertEqual(results["speed"][a, b, c, d], solution.speed)
+                            self.assertAlmostEqual(results["hold"][a, b, c, d], solution.hold)
+
+
 if __name__ == '__main__':
     print(hours_to_time(1.504))
\ No newline at end of file
@@ -1,6 +1,7 @@
 import math
 import haversine
 from haversine import Unit
+import numpy as np
 import unittest
 
 
@@ -74,6 +75,23 @@ class WayPoint:
         return haversine.haversine(self.to_degrees(), wp.to_degrees(), unit=Unit.NAUTICAL_MILES)
 
 
+# bearing_from and distance_from for every leg of a route in one pass, the leg into waypoint i at i - 1
+def get_leg_geometry(waypoints):
+    if len(waypoints) < 2:
+        return [], []
+    degrees = np.array(list(map(lambda wp: wp.to_degrees(), waypoints)))
+    lats = np.radians(degrees[:, 0])
+    longs = np.radians(degrees[:, 1])
+    (prev_lat, own_lat) = (lats[:-1], lats[1:])
+    long_change = longs[1:] - longs[:-1]
+
+    x = np.cos(own_lat) * np.sin(long_change)
+    y = np.cos(prev_lat) * np.sin(own_lat) - np.sin(prev_lat) * np.cos(own_lat) * np.cos(long_change)
+    bearings = np.round((np.arctan2(x, y) * 180 / np.pi + 360) % 360).astype(int)
+    distances = haversine.haversine_vector(degrees[1:], degrees[:-1], unit=Unit.NAUTICAL_MILES)
+    return bearings.tolist(), distances.tolist()
+
+
 class TestWaypoint(unittest.TestCase):
     def test_bearing_correct_on_long(self):
         self.assertEqual(
@@ -123,6 +141,18 @@ class TestWaypoint(unittest.TestCase):
             35
         )
 
+    def test_leg_geometry_matches_bearing_and_distance_from(self):
+        waypoints = [
+            WayPoint(["wp1", "43", "10", "0", "38", "20", "0"], 0),
+            WayPoint(["wp2", "43", "30", "30", "39", "40", "0"], 1),
+            WayPoint(["wp3", "42", "50", "0", "40", "10", "15"], 2),
+            WayPoint(["wp4", "0", "0", "0", "0", "0", "0"], 3)
+        ]
+        (bearings, distances) = get_leg_geometry(waypoints)
+        for i in range(1, len(waypoints)):
+            self.assertEqual(bearings[i - 1], waypoints[i].bearing_from(waypoints[i - 1]))
+            self.assertAlmostEqual(distances[i - 1], waypoints[i].distance_from(waypoints[i - 1]))
+
 
 if __name__ == "__main__":
     unittest.main()